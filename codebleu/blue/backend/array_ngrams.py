@@ -0,0 +1,53 @@
+"""NumPy n-gram engine: integer token IDs and rolling n-gram keys instead of tuple Counters.
+
+Keys are exact, not probabilistic: after each order the rolling key is
+re-densified with np.unique, so key * vocab + next_id never overflows int64
+and two n-grams share a key only if they are equal. Clipped counts come from
+bincount over the joint candidate/reference key space.
+"""
+import numpy as np
+
+
+def token_ids(candidate_tokens, reference_tokens, keywords=()):
+    """Map both token lists onto one joint vocabulary; also flag keyword IDs.
+
+    IDs come from a dict in first-seen order; a fixed-width string array would
+    be as wide as the longest token on every row.
+    """
+    vocab = {}
+    encode = lambda tokens: np.fromiter((vocab.setdefault(tok, len(vocab)) for tok in tokens), np.int64)
+    cand_ids, ref_ids = encode(candidate_tokens), encode(reference_tokens)
+    is_keyword = np.zeros(len(vocab), bool)
+    if keywords:
+        is_keyword[[i for tok, i in vocab.items() if tok in keywords]] = True
+    return cand_ids, ref_ids, len(vocab), is_keyword
+
+
+def order_stats(candidate_tokens, reference_tokens, keywords=(), max_order: int=4):
+    """Per order n: (clipped, total, keyword clipped, keyword total) n-gram counts.
+
+    Matches the Counter engine in evaluator exactly; the "keyword" columns count
+    n-grams containing at least one keyword.
+    """
+    cand_ids, ref_ids, vocab_size, is_keyword = token_ids(candidate_tokens, reference_tokens, keywords)
+    cand_keys, ref_keys = cand_ids, ref_ids
+    cand_kw = is_keyword[cand_ids]
+    key_space = vocab_size
+    stats = []
+    for n in range(1, max_order + 1):
+        if n > 1:
+            cand_keys = cand_keys[:-1] * vocab_size + cand_ids[n-1:]
+            ref_keys = ref_keys[:-1] * vocab_size + ref_ids[n-1:]
+            cand_kw = cand_kw[:-1] | is_keyword[cand_ids[n-1:]]
+            uniq, dense = np.unique(np.concatenate([cand_keys, ref_keys]), return_inverse=True)
+            key_space = len(uniq)
+            cand_keys, ref_keys = dense[:len(cand_keys)], dense[len(cand_keys):]
+        if not len(cand_keys):
+            stats.append((0, 0, 0, 0))
+            continue
+        clipped = np.minimum(np.bincount(cand_keys, minlength=key_space), np.bincount(ref_keys, minlength=key_space))
+        kw_keys = np.zeros(key_space, bool)
+        kw_keys[cand_keys[cand_kw]] = True
+        stats.append((int(clipped.sum()), len(cand_keys),
+                      int(clipped[kw_keys].sum()), int(np.count_nonzero(cand_kw))))
+    return stats
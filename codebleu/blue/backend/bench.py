@@ -0,0 +1,200 @@
+"""Reproducible benchmarks for the scoring hot path and the /evaluate endpoint.
+
+    python -m bench --save baseline.json
+    python -m bench --compare baseline.json --threshold 1.25
+
+Synthetic reference/candidate pairs are generated per language and size from
+a fixed seed. Each function is timed over repeated runs and the median is
+reported; results are written as JSON. With --compare, any benchmark slower
+than threshold x its baseline is reported and the exit status is 1.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+from unittest import mock
+
+import evaluator
+from evaluator import (LANG_KEYWORDS, bleu_4, clear_profile_cache, compute_codebleu_detailed, keyword_weighted_precision,
+                       ngram_counts, syntax_overlap, tokenize_code)
+
+DEFAULT_SIZES = (10, 100, 1000, 10000, 100000)
+DEFAULT_LANGUAGES = ("python", "cpp", "java", "javascript")
+OPERATORS = ("=", "==", "!=", "<", ">", "+", "-", "*", "/", "%", "+=", "<=")
+
+
+def synthetic_code(language: str, n_tokens: int, rng: random.Random) -> str:
+    """Roughly n_tokens of keyword/identifier/operator/brace soup with code-like shape."""
+    keywords = sorted(LANG_KEYWORDS.get(language, ()))
+    identifiers = [f"var_{i}" for i in range(max(8, n_tokens // 20))]
+    terminator = "" if language == "python" else ";"
+    lines, count = [], 0
+    while count < n_tokens:
+        kind = rng.random()
+        if kind < 0.3 and keywords:
+            line = f"{rng.choice(keywords)} {rng.choice(identifiers)} ({rng.choice(identifiers)}, {rng.randint(0, 99)})"
+            count += 7
+        elif kind < 0.8:
+            a, b, c = (rng.choice(identifiers) for _ in range(3))
+            line = f"{a} = {b} {rng.choice(OPERATORS)} {c}[{rng.randint(0, 9)}]{terminator}"
+            count += 8 + bool(terminator)
+        else:
+            line = f"{rng.choice(identifiers)}({rng.choice(identifiers)}){terminator}"
+            count += 4 + bool(terminator)
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def mutate(code: str, rng: random.Random, rate: float=0.2) -> str:
+    """Candidate: the reference with a fraction of its tokens replaced or dropped."""
+    tokens = tokenize_code(code)
+    out = []
+    for tok in tokens:
+        r = rng.random()
+        if r < rate / 2:
+            continue
+        out.append(f"alt_{tok}" if r < rate and tok.isidentifier() else tok)
+    return " ".join(out)
+
+
+def make_corpus(languages, sizes, seed: int=0) -> dict:
+    rng = random.Random(seed)
+    corpus = {}
+    for language in languages:
+        for size in sizes:
+            reference = synthetic_code(language, size, rng)
+            corpus[(language, size)] = (reference, mutate(reference, rng))
+    return corpus
+
+
+def time_call(fn, min_time: float=0.2, max_runs: int=50, setup=None) -> dict:
+    """Median wall time of fn() over repeated runs, at least 3 and up to max_runs or ~min_time."""
+    samples, spent = [], 0.0
+    while len(samples) < 3 or (spent < min_time and len(samples) < max_runs):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        samples.append(elapsed)
+        spent += elapsed
+    return {"median_s": statistics.median(samples), "min_s": min(samples), "runs": len(samples)}
+
+
+def bench_evaluator(corpus, min_time: float) -> dict:
+    results = {}
+    for (language, size), (reference, candidate) in corpus.items():
+        ref_tokens, cand_tokens = tokenize_code(reference), tokenize_code(candidate)
+        cases = {
+            "tokenize_code": lambda: tokenize_code(candidate),
+            "ngram_counts": lambda: [ngram_counts(cand_tokens, n) for n in range(1, 5)],
+            "bleu_4": lambda: bleu_4(cand_tokens, ref_tokens),
+            "keyword_weighted_precision": lambda: keyword_weighted_precision(cand_tokens, ref_tokens, language),
+            "syntax_overlap": lambda: syntax_overlap(candidate, reference),
+        }
+        for name, fn in cases.items():
+            results[f"{name}/{language}/{size}"] = time_call(fn, min_time)
+        results[f"compute_codebleu_detailed/{language}/{size}"] = time_call(
+            lambda: compute_codebleu_detailed(reference, candidate, language), min_time, setup=clear_profile_cache)
+        results[f"compute_codebleu_detailed_warm/{language}/{size}"] = time_call(
+            lambda: compute_codebleu_detailed(reference, candidate, language), min_time)
+    return results
+
+
+def bench_http(corpus, requests_per_case: int=200) -> dict:
+    try:
+        from main import app
+    except ImportError as e:
+        print(f"skipping /evaluate benchmarks: {e}", file=sys.stderr)
+        return {}
+    client = app.test_client()
+    results = {}
+    for (language, size), (reference, candidate) in corpus.items():
+        if size > 1000:
+            continue
+        body = {"reference": reference, "candidate": candidate, "language": language}
+        clear_profile_cache()
+        # With the result store on, every repeat would be a SQLite lookup (and land in the developer's store).
+        with mock.patch.dict(os.environ, {"RESULT_STORE": "0"}):
+            start = time.perf_counter()
+            for _ in range(requests_per_case):
+                client.post("/evaluate", json=body)
+            elapsed = time.perf_counter() - start
+        results[f"http_evaluate/{language}/{size}"] = {
+            "median_s": elapsed / requests_per_case,
+            "requests_per_s": requests_per_case / elapsed,
+            "runs": requests_per_case,
+        }
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """Return (name, baseline_s, current_s, ratio) for every benchmark slower than threshold."""
+    regressions = []
+    for name, current in sorted(results.items()):
+        base = baseline.get(name)
+        if not base or not base.get("median_s"):
+            continue
+        ratio = current["median_s"] / base["median_s"]
+        if ratio > threshold:
+            regressions.append((name, base["median_s"], current["median_s"], ratio))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench", description="Benchmark the CodeBLEU evaluator.")
+    parser.add_argument("--languages", nargs="+", default=list(DEFAULT_LANGUAGES))
+    parser.add_argument("--sizes", nargs="+", type=int, default=list(DEFAULT_SIZES), help="approximate tokens per text")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds to spend per benchmark")
+    parser.add_argument("--no-http", action="store_true", help="skip the Flask /evaluate benchmarks")
+    parser.add_argument("--engine", choices=evaluator.NGRAM_ENGINES, help="n-gram engine to benchmark")
+    parser.add_argument("-o", "--output", default="-", help="write results JSON here (default stdout)")
+    parser.add_argument("--save", help="also write results as a baseline file")
+    parser.add_argument("--compare", help="baseline JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=1.25, help="slowdown ratio counted as a regression")
+    args = parser.parse_args(argv)
+    if args.engine:
+        evaluator.set_ngram_engine(args.engine)
+
+    corpus = make_corpus(args.languages, args.sizes, args.seed)
+    results = bench_evaluator(corpus, args.min_time)
+    if not args.no_http:
+        results.update(bench_http(corpus))
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "engine": evaluator.NGRAM_ENGINE,
+            "seed": args.seed,
+            "timestamp": time.time(),
+        },
+        "results": results,
+    }
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output == "-":
+        print(text)
+    else:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            f.write(text)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        for name, base, current, ratio in regressions:
+            print(f"REGRESSION {name}: {base * 1e3:.3f} ms -> {current * 1e3:.3f} ms ({ratio:.2f}x)", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
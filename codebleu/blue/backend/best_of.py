@@ -0,0 +1,90 @@
+"""Best-of-N generation: sample N completions in parallel and keep the one closest to a reference.
+
+Samples are spread round-robin over the healthy backends in router order,
+each with its own temperature and seed, and run on the LLM worker pool. At
+most BEST_OF_MAX_INFLIGHT samples run at once across all requests; the rest
+wait their turn, so best-of cannot take every Replicate slot. Each
+completion is scored with compute_codebleu_detailed as soon as it arrives.
+Once one reaches the threshold FinalScore the result is returned and the rest
+are cancelled: queued ones never start, running ones are stopped through the
+shared cancel event (which also cancels their Replicate predictions).
+"""
+import os
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+
+from evaluator import compute_codebleu_detailed
+from llm import (REPLICATE_MAX_INFLIGHT, _executor, call_ollama, call_replicate, configured_backends, get_router,
+                 is_valid_code)
+
+BEST_OF_MAX_N = int(os.environ.get("BEST_OF_MAX_N", "8"))
+# Samples in flight across all best-of requests; kept below REPLICATE_MAX_INFLIGHT so plain /generate always has room.
+BEST_OF_MAX_INFLIGHT = int(os.environ.get("BEST_OF_MAX_INFLIGHT", str(max(1, REPLICATE_MAX_INFLIGHT // 2))))
+DEFAULT_TEMPERATURE = 0.8
+# How often a request with queued samples checks whether another request freed a slot.
+_SLOT_POLL = 0.05
+
+_CALLS = {"ollama": call_ollama, "replicate": call_replicate}
+_slots = threading.BoundedSemaphore(BEST_OF_MAX_INFLIGHT)
+
+
+def sampling_plan(n: int, temperature=DEFAULT_TEMPERATURE, seed: int=0) -> list:
+    """Per-sample {"temperature", "seed"}; temperature may be one value or a list of n."""
+    temperatures = list(temperature) if isinstance(temperature, (list, tuple)) else [temperature] * n
+    if len(temperatures) != n:
+        raise ValueError(f"expected {n} temperatures, got {len(temperatures)}")
+    return [{"temperature": float(t), "seed": seed + i} for i, t in enumerate(temperatures)]
+
+
+def generate_best_of(language: str, prompt: str, reference: str, n: int=4, threshold: float=None,
+                     temperature=DEFAULT_TEMPERATURE, seed: int=0, use_ollama: bool=None) -> dict:
+    """Generate n completions, score each against reference, and return the best along with every sample."""
+    plan = sampling_plan(n, temperature, seed)
+    router = get_router()
+    backends = router.order(configured_backends(use_ollama))
+    cancel = threading.Event()
+    samples = [{"index": i, **sampling, "backend": None} for i, sampling in enumerate(plan)]
+    futures, queued, pending = {}, deque(range(n)), set()
+    best, stopped_early = None, False
+    while queued or pending:
+        # Start queued samples while shared slots are free; wait for one only when nothing of ours is running.
+        while queued and _slots.acquire(timeout=None if not pending else 0):
+            i = queued.popleft()
+            # Round-robin from this sample's slot, skipping backends that refuse admission (open or busy half-open).
+            start = i % len(backends) if backends else 0
+            name = next((b for b in backends[start:] + backends[:start] if router.admit(b)), None)
+            if name is None:
+                _slots.release()
+                samples[i].update(status=503, error=router.unavailable_message(configured_backends(use_ollama)))
+                continue
+            samples[i]["backend"] = name
+            future = _executor.submit(_CALLS[name], language, prompt, cancel=cancel, sampling=plan[i])
+            future.add_done_callback(lambda _: _slots.release())
+            futures[future] = i
+            pending.add(future)
+        if not pending:
+            break
+        done, pending = wait(pending, timeout=_SLOT_POLL if queued else None, return_when=FIRST_COMPLETED)
+        for future in done:
+            sample = samples[futures[future]]
+            status, body = future.result()
+            sample["status"] = status
+            if not is_valid_code(status, body):
+                sample["error"] = body
+                continue
+            sample["code"] = body
+            sample["scores"] = compute_codebleu_detailed(reference, body, language)
+            if best is None or sample["scores"]["FinalScore"] > best["scores"]["FinalScore"]:
+                best = sample
+        if (pending or queued) and threshold is not None and best is not None and best["scores"]["FinalScore"] >= threshold:
+            # Don't wait for the stragglers; they see the cancel event and wind down on their own.
+            stopped_early = True
+            cancel.set()
+            for future in pending:
+                future.cancel()
+                samples[futures[future]].update(status=499, error="Generation cancelled")
+            for i in queued:
+                samples[i].update(status=499, error="Generation cancelled")
+            break
+    return {"best": best, "samples": samples, "stopped_early": stopped_early}
@@ -0,0 +1,179 @@
+"""Score a JSONL file of reference/candidate/language records.
+
+    python -m cli pairs.jsonl -o scores.jsonl --workers 64
+
+Each input line is {"reference": ..., "candidate": ..., "language": ...}; a
+"references" list scores against several references, and an "id" field is
+copied to the output. Use "-" for stdin/stdout.
+
+Records already in the result store (see result_store) are answered from it
+and only the rest are scored; new results are saved back in bulk, along with
+any "prompt"/"model"/"run" labels on the records. --no-store scores everything.
+"""
+import argparse
+import json
+import os
+import sys
+from itertools import chain, islice
+
+import evaluator
+from evaluator import NGRAM_ENGINES, compute_codebleu_detailed, compute_codebleu_multi, set_ngram_engine
+from result_store import get_store, labels_of, result_key
+
+# Jobs no bigger than this are scored in-process; spawning a pool costs more.
+INLINE_LIMIT = 256
+# Records looked up in (and saved to) the result store at a time.
+STORE_CHUNK = 4096
+
+
+def score_record(line: str) -> dict:
+    try:
+        record = json.loads(line)
+        language = str(record.get("language", "python")).lower().strip()
+        candidate = str(record.get("candidate", ""))
+        if "references" in record:
+            result = compute_codebleu_multi([str(r) for r in record["references"]], candidate, language)
+        else:
+            result = compute_codebleu_detailed(str(record.get("reference", "")), candidate, language)
+    except Exception as e:
+        return {"error": f"{type(e).__name__}: {e}"}
+    if "id" in record:
+        result["id"] = record["id"]
+    return result
+
+
+def _pool(workers: int):
+    """Process pool whose workers use this process's n-gram engine.
+
+    Under the spawn start method (Windows, macOS) workers re-import evaluator
+    and would otherwise fall back to the default engine.
+    """
+    import multiprocessing
+    return multiprocessing.Pool(workers, initializer=set_ngram_engine, initargs=(evaluator.NGRAM_ENGINE,))
+
+
+def _score_indexed(item):
+    index, line = item
+    result = score_record(line)
+    result["index"] = index
+    return result
+
+
+def score_lines(lines, workers: int=None, chunksize: int=64, ordered: bool=True, store=None):
+    """Yield one result per non-blank line, fanning out over a process pool when worth it."""
+    lines = (line for line in lines if line.strip())
+    if store is not None:
+        yield from _score_stored(lines, workers, chunksize, ordered, store)
+        return
+    if not ordered:
+        lines = enumerate(lines)
+    scorer = score_record if ordered else _score_indexed
+    head = list(islice(lines, INLINE_LIMIT))
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(head) < INLINE_LIMIT:
+        yield from map(scorer, chain(head, lines))
+        return
+
+    with _pool(workers) as pool:
+        dispatch = pool.imap if ordered else pool.imap_unordered
+        yield from dispatch(scorer, chain(head, lines), chunksize)
+
+
+def _record_key(line: str):
+    """(result key, record) for a line, or (None, None) if it will not parse."""
+    try:
+        record = json.loads(line)
+        language = str(record.get("language", "python")).lower().strip()
+        candidate = str(record.get("candidate", ""))
+        if "references" in record:
+            reference = [str(r) for r in record["references"]]
+        else:
+            reference = str(record.get("reference", ""))
+    except Exception:
+        return None, None
+    return result_key(reference, candidate, language), record
+
+
+def _score_stored(lines, workers: int, chunksize: int, ordered: bool, store):
+    """score_lines through the result store: a chunk of records is looked up at once, misses are scored."""
+    workers = workers or os.cpu_count() or 1
+    pool, offset = None, 0
+    try:
+        while True:
+            chunk = list(islice(lines, STORE_CHUNK))
+            if not chunk:
+                return
+            parsed = [_record_key(line) for line in chunk]
+            found = store.get_many(key for key, _ in parsed if key)
+            todo = [(offset + i, line) for i, (line, (key, _)) in enumerate(zip(chunk, parsed)) if key not in found]
+            if pool is None and workers > 1 and len(todo) >= INLINE_LIMIT:
+                pool = _pool(workers)
+            if pool is None:
+                scored = map(_score_indexed, todo)
+            else:
+                scored = (pool.imap if ordered else pool.imap_unordered)(_score_indexed, todo, chunksize)
+            fresh = []
+
+            def stored(result):
+                key, record = parsed[result["index"] - offset]
+                if key and "error" not in result:
+                    scores = {k: v for k, v in result.items() if k not in ("id", "index")}
+                    fresh.append((key, str(record.get("language", "python")).lower().strip(), scores))
+                if ordered:
+                    del result["index"]
+                return result
+
+            def hit(i, key, record):
+                result = dict(found[key])
+                if "id" in record:
+                    result["id"] = record["id"]
+                if not ordered:
+                    result["index"] = offset + i
+                return result
+
+            if ordered:
+                scored = iter(scored)
+                for i, (key, record) in enumerate(parsed):
+                    yield hit(i, key, record) if key in found else stored(next(scored))
+            else:
+                for i, (key, record) in enumerate(parsed):
+                    if key in found:
+                        yield hit(i, key, record)
+                for result in scored:
+                    yield stored(result)
+            store.put_many(fresh)
+            store.record_many((key, labels_of(record)) for key, record in parsed if key)
+            offset += len(chunk)
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m cli", description="Batch CodeBLEU scoring over JSONL.")
+    parser.add_argument("input", help="JSONL file of records, or - for stdin")
+    parser.add_argument("-o", "--output", default="-", help="output JSONL file (default stdout)")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument("-c", "--chunksize", type=int, default=64, help="records per dispatched chunk")
+    parser.add_argument("--engine", choices=NGRAM_ENGINES, help="n-gram engine (default: CODEBLEU_NGRAM_ENGINE or counter)")
+    parser.add_argument("--unordered", action="store_true", help="emit results as they finish, tagged with index")
+    parser.add_argument("--no-store", action="store_true", help="score every record; don't read or write the result store")
+    args = parser.parse_args(argv)
+    if args.engine:
+        set_ngram_engine(args.engine)
+
+    src = sys.stdin if args.input == "-" else open(args.input, encoding="utf-8")
+    dst = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+    try:
+        store = None if args.no_store else get_store()
+        for result in score_lines(src, args.workers, args.chunksize, not args.unordered, store):
+            dst.write(json.dumps(result) + "\n")
+    finally:
+        if src is not sys.stdin:
+            src.close()
+        if dst is not sys.stdout:
+            dst.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,11 @@
+import hashlib
+import os
 import re
-from collections import Counter
+import sys
+import threading
+from collections import Counter, OrderedDict
+
+from metrics import EVAL_STAGE_SECONDS, timed
 
 LANG_KEYWORDS = {
     "python": {"def","return","if","elif","else","for","while","class","import","from","pass","yield","lambda"},
@@ -8,70 +14,273 @@ LANG_KEYWORDS = {
     "javascript": {"function","return","if","else","for","while","class","const","let","var","new","try","catch","throw"}
 }
 
+MULTI_CHAR_OPS = ("===", "!==", "==", "!=", "<=", ">=", "&&", "||", "++", "--", "+=", "-=", "*=", "/=", "%=", "**", "->", "=>")
+SYNTAX_OPS = ("=", "==", "!=", "<", ">", "+", "-", "*", "/", "%",
+              "===", "!==", "<=", ">=", "&&", "||", "++", "--", "+=", "-=", "*=", "/=", "%=", "**", "->", "=>")
+SYNTAX_BRACES = ("(", ")", "{", "}", "[", "]", ";", ",")
+MAX_ORDER = 4
+# Which structural score feeds FinalScore: "overlap" (operator/brace histograms) or "ast" (SyntaxMatch).
+SYNTAX_COMPONENT = os.environ.get("CODEBLEU_SYNTAX", "overlap")
+# Bump whenever a change alters any score, so stored results (see result_store) are not reused.
+SCORER_VERSION = "2"
+
+_TOKEN_RE = re.compile(r"\w+|" + "|".join(map(re.escape, MULTI_CHAR_OPS)) + r"|[^\s\w]")
+
 def tokenize_code(text: str):
-    """Simple tokenizer: words and single symbols."""
-    return re.findall(r"\w+|[^\s\w]", text)
+    """Simple tokenizer: words, multi-character operators and single symbols."""
+    return _TOKEN_RE.findall(text)
 
 def ngram_counts(tokens, n):
     return Counter(tuple(tokens[i:i+n]) for i in range(len(tokens)-n+1))
 
+
+class CodeScan:
+    """Result of one scan over a text: interned tokens and per-token-class tallies."""
+    __slots__ = ("tokens", "vocab", "ops", "braces", "identifiers", "keywords")
+
+    def __init__(self, tokens, vocab, ops, braces, identifiers, keywords):
+        self.tokens, self.vocab = tokens, vocab
+        self.ops, self.braces = ops, braces
+        self.identifiers, self.keywords = identifiers, keywords
+
+def scan_code(text: str, language: str="python") -> CodeScan:
+    """Tokenize text once and classify it.
+
+    The regex runs a single time; operators, braces, keywords and identifiers
+    are then classified per distinct token rather than per occurrence.
+    """
+    tokens = list(map(sys.intern, _TOKEN_RE.findall(text)))
+    vocab = Counter(tokens)
+    return CodeScan(tokens, vocab, *classify_vocab(vocab, language))
+
+def classify_vocab(vocab: Counter, language: str="python"):
+    """Split token counts into (operator Counter, brace Counter, identifiers, keywords)."""
+    lang_keywords = LANG_KEYWORDS.get(language, set())
+    ops, braces, identifiers, keywords = Counter(), Counter(), set(), set()
+    for tok, c in vocab.items():
+        if tok in _SYNTAX_OP_SET:
+            ops[tok] = c
+        elif tok in _SYNTAX_BRACE_SET:
+            braces[tok] = c
+        elif tok in lang_keywords:
+            keywords.add(tok)
+        elif tok.isidentifier():
+            identifiers.add(tok)
+    return ops, braces, frozenset(identifiers), frozenset(keywords)
+
+_SYNTAX_OP_SET = frozenset(SYNTAX_OPS)
+_SYNTAX_BRACE_SET = frozenset(SYNTAX_BRACES)
+
+
+class CodeProfile:
+    """Everything the metrics need from one text, computed once."""
+    __slots__ = ("language", "text", "tokens", "vocab", "ops", "braces", "identifiers", "keywords", "_ngrams", "_subtrees")
+
+    def __init__(self, text: str, language: str="python"):
+        scan = scan_code(text, language)
+        self.language, self.text = language, text
+        self.tokens, self.vocab = scan.tokens, scan.vocab
+        self.ops, self.braces = scan.ops, scan.braces
+        self.identifiers, self.keywords = scan.identifiers, scan.keywords
+        self._ngrams = self._subtrees = None
+
+    @property
+    def ngrams(self):
+        """Tuple Counters for orders 1..MAX_ORDER (index 0 unused), built on first use."""
+        if self._ngrams is None:
+            ngrams = [None, Counter({(tok,): c for tok, c in self.vocab.items()})]
+            self._ngrams = ngrams + [ngram_counts(self.tokens, n) for n in range(2, MAX_ORDER + 1)]
+        return self._ngrams
+
+    @property
+    def subtrees(self):
+        """Structural-hash counts of the parsed syntax tree (see syntax_match), built on first use."""
+        if self._subtrees is None:
+            from syntax_match import subtree_counts
+            self._subtrees = subtree_counts(self.text, self.language)
+        return self._subtrees
+
+    def __len__(self):
+        return len(self.tokens)
+
+
+PROFILE_CACHE_SIZE = int(os.environ.get("PROFILE_CACHE_SIZE", "1024"))
+# A profile holds a few hundred bytes per token, so the LRU is also bounded by total tokens;
+# a single text above the budget is profiled but not cached.
+PROFILE_CACHE_TOKENS = int(os.environ.get("PROFILE_CACHE_TOKENS", "1000000"))
+_profile_cache = OrderedDict()
+_profile_lock = threading.Lock()
+_profile_stats = {"hits": 0, "misses": 0}
+_profile_tokens = 0
+
+def get_profile(text: str, language: str="python") -> CodeProfile:
+    """Return a CodeProfile for text, served from a bounded LRU keyed by content hash."""
+    global _profile_tokens
+    key = (hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest(), language)
+    with _profile_lock:
+        profile = _profile_cache.get(key)
+        if profile is not None:
+            _profile_cache.move_to_end(key)
+            _profile_stats["hits"] += 1
+            return profile
+        _profile_stats["misses"] += 1
+    profile = CodeProfile(text, language)
+    if len(profile) > PROFILE_CACHE_TOKENS:
+        return profile
+    with _profile_lock:
+        if key not in _profile_cache:
+            _profile_cache[key] = profile
+            _profile_tokens += len(profile)
+        while len(_profile_cache) > PROFILE_CACHE_SIZE or _profile_tokens > PROFILE_CACHE_TOKENS:
+            _profile_tokens -= len(_profile_cache.popitem(last=False)[1])
+    return profile
+
+def clear_profile_cache():
+    global _profile_tokens
+    with _profile_lock:
+        _profile_cache.clear()
+        _profile_tokens = 0
+
+def profile_cache_stats() -> dict:
+    with _profile_lock:
+        return {"entries": len(_profile_cache), "tokens": _profile_tokens, **_profile_stats}
+
+def _ngrams(source, n):
+    if isinstance(source, (CodeProfile, ReferenceSet)):
+        return source.ngrams[n]
+    return ngram_counts(source, n)
+
 def clipped_precision(candidate_tokens, reference_tokens, n):
-    cand_counts = ngram_counts(candidate_tokens, n)
-    ref_counts = ngram_counts(reference_tokens, n)
+    cand_counts = _ngrams(candidate_tokens, n)
+    ref_counts = _ngrams(reference_tokens, n)
     clip = sum(min(c, ref_counts.get(ng, 0)) for ng, c in cand_counts.items())
     total = sum(cand_counts.values())
     return clip / total if total > 0 else 0.0
 
-def bleu_4(candidate_tokens, reference_tokens):
-    precisions = [clipped_precision(candidate_tokens, reference_tokens, n) for n in range(1, 5)]
+NGRAM_ENGINE = os.environ.get("CODEBLEU_NGRAM_ENGINE", "counter")
+NGRAM_ENGINES = ("counter", "numpy")
+
+def set_ngram_engine(engine: str):
+    """Select the n-gram engine: "counter" (tuple Counters) or "numpy" (array_ngrams)."""
+    global NGRAM_ENGINE
+    if engine not in NGRAM_ENGINES:
+        raise ValueError(f"unknown n-gram engine {engine!r}, expected one of {NGRAM_ENGINES}")
+    if engine == "numpy":
+        import array_ngrams  # noqa: F401 -- fail here rather than mid-request if NumPy is missing
+    NGRAM_ENGINE = engine
+
+def _order_stats(candidate, reference, keywords=(), engine=None):
+    """Per order n: (clipped, total, keyword clipped, keyword total) n-gram counts."""
+    engine = engine or NGRAM_ENGINE
+    if engine == "numpy" and not isinstance(reference, ReferenceSet):
+        from array_ngrams import order_stats
+        tokens = lambda src: src.tokens if isinstance(src, CodeProfile) else src
+        return order_stats(tokens(candidate), tokens(reference), keywords, MAX_ORDER)
+    stats = []
+    for n in range(1, MAX_ORDER + 1):
+        cand_counts = _ngrams(candidate, n)
+        ref_counts = _ngrams(reference, n)
+        clip = total = kw_clip = kw_total = 0
+        for ng, c in cand_counts.items():
+            m = min(c, ref_counts.get(ng, 0))
+            clip += m
+            total += c
+            if keywords and any(tok in keywords for tok in ng):
+                kw_clip += m
+                kw_total += c
+        stats.append((clip, total, kw_clip, kw_total))
+    return stats
+
+def _bleu_from_stats(stats, cand_len, ref_len):
+    precisions = [clip / total if total > 0 else 0.0 for clip, total, _, _ in stats]
     if any(p == 0 for p in precisions):
         geo_mean = 0.0
     else:
         prod = 1.0
         for p in precisions: prod *= p
         geo_mean = prod ** 0.25
-    bp = 1.0 if len(candidate_tokens) > len(reference_tokens) else (len(candidate_tokens)/len(reference_tokens) if reference_tokens else 1.0)
+    bp = 1.0 if cand_len > ref_len else (cand_len/ref_len if ref_len else 1.0)
     return bp * geo_mean
 
-def keyword_weighted_precision(candidate_tokens, reference_tokens, language):
-    keywords = LANG_KEYWORDS.get(language, set())
-    weight_factor = 1.1
-    score, total = 0.0, 0.0
-    for n in range(1, 5):
-        cand_counts = ngram_counts(candidate_tokens, n)
-        ref_counts = ngram_counts(reference_tokens, n)
-        for ng, c in cand_counts.items():
-            w = weight_factor if any(tok in keywords for tok in ng) else 1.0
-            total += w * c
-            score += w * min(c, ref_counts.get(ng, 0))
+def _keyword_from_stats(stats, weight_factor=1.1):
+    clip = sum(s[0] for s in stats)
+    total = sum(s[1] for s in stats)
+    kw_clip = sum(s[2] for s in stats)
+    kw_total = sum(s[3] for s in stats)
+    score = (clip - kw_clip) + weight_factor * kw_clip
+    total = (total - kw_total) + weight_factor * kw_total
     return score / total if total > 0 else 0.0
 
-def syntax_overlap(candidate: str, reference: str):
-    ops = ["=", "==", "!=", "<", ">", "+", "-", "*", "/", "%"]
-    braces = ["(", ")", "{", "}", "[", "]", ";", ","]
-    def freq(text, symbols): return Counter(tok for tok in tokenize_code(text) if tok in symbols)
-    cand_ops, ref_ops = freq(candidate, ops), freq(reference, ops)
-    cand_br, ref_br = freq(candidate, braces), freq(reference, braces)
-    def jaccard_like(a, b):
-        keys = set(a.keys()) | set(b.keys())
-        inter = sum(min(a.get(k,0), b.get(k,0)) for k in keys)
-        union = sum(max(a.get(k,0), b.get(k,0)) for k in keys)
-        return inter/union if union>0 else 0.0
-    return 0.5*jaccard_like(cand_ops, ref_ops) + 0.5*jaccard_like(cand_br, ref_br)
-
-def compute_codebleu_detailed(reference: str, candidate: str, language: str="python") -> dict:
-    ref_tokens, cand_tokens = tokenize_code(reference), tokenize_code(candidate)
-
-    bleu = bleu_4(cand_tokens, ref_tokens)
-    kw = keyword_weighted_precision(cand_tokens, ref_tokens, language)
-    syn = syntax_overlap(candidate, reference)
-
-    identifiers_ref = [tok for tok in ref_tokens if tok.isidentifier() and tok not in LANG_KEYWORDS.get(language, set())]
-    identifiers_cand = [tok for tok in cand_tokens if tok.isidentifier() and tok not in LANG_KEYWORDS.get(language, set())]
-    overlap = len(set(identifiers_ref) & set(identifiers_cand))
-    penalty = overlap / max(len(set(identifiers_ref + identifiers_cand)), 1)
-
-    final_score = (0.4*bleu + 0.4*kw + 0.2*syn) * penalty
+def _keywords_for(candidate, language):
+    keywords = LANG_KEYWORDS.get(language, set())
+    if isinstance(candidate, CodeProfile) and candidate.language == language and not candidate.keywords:
+        return ()
+    return keywords
+
+def bleu_4(candidate_tokens, reference_tokens, engine=None):
+    stats = _order_stats(candidate_tokens, reference_tokens, engine=engine)
+    return _bleu_from_stats(stats, len(candidate_tokens), len(reference_tokens))
+
+def keyword_weighted_precision(candidate_tokens, reference_tokens, language, engine=None):
+    keywords = _keywords_for(candidate_tokens, language)
+    return _keyword_from_stats(_order_stats(candidate_tokens, reference_tokens, keywords, engine))
+
+def _jaccard_like(a, b):
+    keys = set(a.keys()) | set(b.keys())
+    inter = sum(min(a.get(k,0), b.get(k,0)) for k in keys)
+    union = sum(max(a.get(k,0), b.get(k,0)) for k in keys)
+    return inter/union if union>0 else 0.0
+
+def syntax_overlap(candidate, reference):
+    if not isinstance(candidate, CodeProfile):
+        candidate = CodeProfile(candidate)
+    if not isinstance(reference, CodeProfile):
+        reference = CodeProfile(reference)
+    return 0.5*_jaccard_like(candidate.ops, reference.ops) + 0.5*_jaccard_like(candidate.braces, reference.braces)
+
+def ast_syntax_match(candidate: CodeProfile, reference: CodeProfile):
+    """SyntaxMatch of two profiles, or None when either has no syntax tree (see file_eval)."""
+    from syntax_match import syntax_match
+    if candidate.subtrees is None or reference.subtrees is None:
+        return None
+    return syntax_match(candidate.subtrees, reference.subtrees)
+
+def identifier_penalty(candidate: CodeProfile, reference: CodeProfile):
+    overlap = len(reference.identifiers & candidate.identifiers)
+    return overlap / max(len(reference.identifiers | candidate.identifiers), 1)
+
+def _wants_match(with_syntax_match) -> bool:
+    """SyntaxMatch needs a parse; by default it is only computed when it feeds FinalScore."""
+    return SYNTAX_COMPONENT == "ast" if with_syntax_match is None else bool(with_syntax_match)
+
+def compute_codebleu_detailed(reference: str, candidate: str, language: str="python", engine=None,
+                              with_syntax_match: bool=None) -> dict:
+    with timed(EVAL_STAGE_SECONDS, stage="profile"):
+        ref, cand = get_profile(reference, language), get_profile(candidate, language)
+    return score_profiles(ref, cand, language, engine, with_syntax_match)
+
+def score_profiles(ref: CodeProfile, cand: CodeProfile, language: str="python", engine=None,
+                   with_syntax_match: bool=None) -> dict:
+    """Score two profiles; SyntaxMatch is included when with_syntax_match (default: CODEBLEU_SYNTAX=ast)."""
+    with timed(EVAL_STAGE_SECONDS, stage="ngram_stats"):
+        stats = _order_stats(cand, ref, _keywords_for(cand, language), engine)
+        bleu = _bleu_from_stats(stats, len(cand), len(ref))
+        kw = _keyword_from_stats(stats)
+    with timed(EVAL_STAGE_SECONDS, stage="syntax_overlap"):
+        syn = syntax_overlap(cand, ref)
+    match = None
+    if _wants_match(with_syntax_match):
+        with timed(EVAL_STAGE_SECONDS, stage="syntax_match"):
+            match = ast_syntax_match(cand, ref)
+    with timed(EVAL_STAGE_SECONDS, stage="identifier_penalty"):
+        penalty = identifier_penalty(cand, ref)
+
+    return _report(bleu, kw, syn, penalty, match)
+
+def _report(bleu, kw, syn, penalty, match=None) -> dict:
+    """Build the score breakdown; CODEBLEU_SYNTAX=ast makes SyntaxMatch the syntax component."""
+    structure = match if SYNTAX_COMPONENT == "ast" and match is not None else syn
+    final_score = (0.4*bleu + 0.4*kw + 0.2*structure) * penalty
 
     recommendations = []
     if penalty < 1.0:
@@ -80,10 +289,10 @@ def compute_codebleu_detailed(reference: str, candidate: str, language: str="pyt
         recommendations.append("N-gram overlap is low, consider revising logic.")
     if kw < 0.7:
         recommendations.append("Keyword usage differs, check control structures.")
-    if syn < 0.7:
+    if structure < 0.7:
         recommendations.append("Syntax structure mismatch, review operators/braces.")
 
-    return {
+    result = {
         "BLEU-4": round(bleu, 4),
         "KeywordPrecision": round(kw, 4),
         "SyntaxOverlap": round(syn, 4),
@@ -91,3 +300,129 @@ def compute_codebleu_detailed(reference: str, candidate: str, language: str="pyt
         "FinalScore": round(final_score, 4),
         "Recommendations": recommendations or ["Code looks structurally similar."]
     }
+    if match is not None:
+        result["SyntaxMatch"] = round(match, 4)
+    return result
+
+def compute_codebleu_batch(pairs, language: str="python"):
+    """Score (reference, candidate[, language]) pairs or dicts in order, lazily.
+
+    Profiles come from the shared LRU, so a reference repeated across the batch
+    is tokenized once while memory stays bounded on long batches.
+    """
+    for pair in pairs:
+        yield compute_codebleu_detailed(*batch_pair(pair, language))
+
+def batch_pair(pair, language: str="python"):
+    """(reference, candidate, language) of a batch item: a dict or a (reference, candidate[, language]) tuple.
+
+    Raises ValueError for anything else, so callers can reject a batch before scoring it.
+    """
+    if isinstance(pair, dict):
+        reference = str(pair.get("reference", ""))
+        candidate = str(pair.get("candidate", ""))
+        return reference, candidate, str(pair.get("language", language)).lower().strip()
+    if not isinstance(pair, (list, tuple)) or len(pair) not in (2, 3) or not all(isinstance(x, str) for x in pair):
+        raise ValueError("expected an object or a [reference, candidate(, language)] list of strings")
+    return (tuple(pair) + (language,))[:3]
+
+
+class ReferenceSet:
+    """Reference profiles merged once: per-order n-gram maxima and lengths.
+
+    Only n-grams are clipped against the merged maxima; the syntax and
+    identifier ratios are taken from whichever single reference the candidate
+    matches best, so adding a reference never lowers a score.
+    """
+    __slots__ = ("language", "lengths", "ngrams", "profiles")
+
+    def __init__(self, profiles, language: str="python"):
+        self.profiles = list(profiles) or [CodeProfile("", language)]
+        self.language = language
+        self.lengths = sorted(len(p) for p in self.profiles)
+        if len(self.profiles) == 1:
+            self.ngrams = self.profiles[0].ngrams
+            return
+        self.ngrams = [None] + [Counter() for _ in range(MAX_ORDER)]
+        for ref in self.profiles:
+            for n in range(1, MAX_ORDER + 1):
+                self.ngrams[n] |= ref.ngrams[n]
+
+    @classmethod
+    def from_texts(cls, references, language: str="python"):
+        if isinstance(references, str):
+            references = [references]
+        return cls((get_profile(ref, language) for ref in references), language)
+
+    def closest_length(self, cand_len: int) -> int:
+        return min(self.lengths, key=lambda r: (abs(r - cand_len), r))
+
+
+def _overlap_counts(a, b) -> tuple:
+    keys = set(a) | set(b)
+    return (sum(min(a.get(k, 0), b.get(k, 0)) for k in keys), sum(max(a.get(k, 0), b.get(k, 0)) for k in keys))
+
+def _ratio(num, den):
+    return num / den if den > 0 else 0.0
+
+def _pair_stats(cand: CodeProfile, refs: ReferenceSet, keywords, with_match: bool=True) -> list:
+    """Sufficient statistics for one candidate, laid out so they sum over a corpus.
+
+    Four n-gram counts per order (see _order_stats), then operator and brace
+    intersection/union, identifier overlap/union, candidate and reference
+    length, and matched/total reference subtrees. Each numerator/denominator
+    pair after the n-grams comes from the reference with the best ratio.
+    The subtree counts are zero unless with_match, which needs a parse.
+    """
+    if not cand.keywords:
+        keywords = ()
+    stats = [x for order in _order_stats(cand, refs, keywords) for x in order]
+    ops, braces = max(((_overlap_counts(cand.ops, r.ops), _overlap_counts(cand.braces, r.braces)) for r in refs.profiles),
+                      key=lambda s: 0.5*_ratio(*s[0]) + 0.5*_ratio(*s[1]))
+    stats.extend(ops + braces)
+    stats.extend(max(((len(cand.identifiers & r.identifiers), max(len(cand.identifiers | r.identifiers), 1))
+                      for r in refs.profiles), key=lambda s: _ratio(*s)))
+    stats.append(len(cand))
+    stats.append(refs.closest_length(len(cand)))
+    if not with_match:
+        return stats + [0, 0]
+    stats.extend(max(((sum(min(c, cand.subtrees.get(h, 0)) for h, c in r.subtrees.items()), sum(r.subtrees.values()))
+                      for r in refs.profiles), key=lambda s: _ratio(*s)))
+    return stats
+
+def _scores_from_stats(stats, with_match: bool=True) -> tuple:
+    orders = [tuple(stats[i:i+4]) for i in range(0, 4*MAX_ORDER, 4)]
+    ops_inter, ops_union, br_inter, br_union, id_overlap, id_union, cand_len, ref_len, matched, subtrees = stats[4*MAX_ORDER:]
+    bleu = _bleu_from_stats(orders, cand_len, ref_len)
+    kw = _keyword_from_stats(orders)
+    syn = 0.5*_ratio(ops_inter, ops_union) + 0.5*_ratio(br_inter, br_union)
+    return bleu, kw, syn, _ratio(id_overlap, id_union), _ratio(matched, subtrees) if with_match else None
+
+def compute_codebleu_multi(references, candidate: str, language: str="python", with_syntax_match: bool=None) -> dict:
+    """Score one candidate against several references, max-clipping n-grams over them.
+
+    The syntax and identifier ratios come from the best-matching reference.
+    """
+    with_match = _wants_match(with_syntax_match)
+    refs = references if isinstance(references, ReferenceSet) else ReferenceSet.from_texts(references, language)
+    stats = _pair_stats(get_profile(candidate, language), refs, LANG_KEYWORDS.get(language, set()), with_match)
+    return _report(*_scores_from_stats(stats, with_match))
+
+def compute_codebleu_corpus(references, candidates, language: str="python", with_syntax_match: bool=None) -> dict:
+    """Corpus-level CodeBLEU: clipped counts and lengths are summed before dividing.
+
+    references[i] is a string, a list of strings or a prebuilt ReferenceSet for
+    candidates[i]. The brevity penalty uses the closest reference length per
+    candidate and the same linear form as bleu_4, so a one-pair corpus scores
+    exactly like compute_codebleu_detailed.
+    """
+    keywords = LANG_KEYWORDS.get(language, set())
+    with_match = _wants_match(with_syntax_match)
+    totals = None
+    for ref, candidate in zip(references, candidates):
+        refs = ref if isinstance(ref, ReferenceSet) else ReferenceSet.from_texts(ref, language)
+        stats = _pair_stats(get_profile(candidate, language), refs, keywords, with_match)
+        totals = stats if totals is None else [a + b for a, b in zip(totals, stats)]
+    if totals is None:
+        return _report(0.0, 0.0, 0.0, 0.0, 0.0 if with_match else None)
+    return _report(*_scores_from_stats(totals, with_match))
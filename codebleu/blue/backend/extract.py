@@ -0,0 +1,105 @@
+"""Pull the code out of an LLM completion, incrementally, as it streams in.
+
+Models are told to emit bare code but usually wrap it in a ``` fence and
+follow it with an explanation. CodeExtractor consumes the completion chunk by
+chunk and reports done as soon as the first non-empty fenced block closes, so
+the caller can stop the upstream generation instead of paying for the rest.
+If no fenced block turns up, finish() falls back to a keyword heuristic over
+the whole text. The result is the same as running extract_code on the complete
+text.
+"""
+
+FENCE = "```"
+
+
+def fallback_from_code_line(content: str) -> str:
+    """Everything from the first line that looks like code (Replicate's heuristic)."""
+    code_indicators = ("def ", "class ", "if __name__", "import ", "return ")
+    if any(tok in content for tok in code_indicators):
+        lines = content.splitlines()
+        for i, line in enumerate(lines):
+            if any(tok in line for tok in code_indicators):
+                return "\n".join(lines[i:]).strip()
+    return content
+
+
+def fallback_whole_text(content: str) -> str:
+    """The whole text if it contains anything code-like (Ollama's heuristic)."""
+    code_indicators = ("def ", "class ", "import ", "return ", ";", "{", "}")
+    if any(tok in content for tok in code_indicators):
+        return content.strip()
+    return content
+
+
+FALLBACKS = {"replicate": fallback_from_code_line, "ollama": fallback_whole_text}
+
+
+def _block_code(block: str) -> str:
+    """A fenced block's code, without the language tag on its first line."""
+    lines = block.splitlines()
+    if lines and lines[0].strip().isalpha():
+        return "\n".join(lines[1:]).strip()
+    return block.strip()
+
+
+class CodeExtractor:
+    def __init__(self, fallback=fallback_from_code_line):
+        self.fallback = fallback
+        self.code = None     # first non-empty fenced block, once it has closed
+        self._parts = []     # everything fed so far, for the fallback
+        self._block = None   # pieces of the fenced block being read, or None outside a block
+        self._carry = ""     # trailing backticks that may be the start of a fence
+
+    @property
+    def done(self) -> bool:
+        return self.code is not None
+
+    def feed(self, chunk: str) -> bool:
+        """Consume the next piece of the completion; True once the code is known."""
+        if self.code is not None:
+            return True
+        self._parts.append(chunk)
+        text, pos = self._carry + chunk, 0
+        while True:
+            i = text.find(FENCE, pos)
+            if i < 0:
+                break
+            self._take(text[pos:i])
+            pos = i + len(FENCE)
+            if self._block is None:
+                self._block = []
+                continue
+            code, self._block = _block_code("".join(self._block)), None
+            if code:
+                self.code = code
+                return True
+        rest = text[pos:]
+        hold = len(rest) - len(rest.rstrip("`"))
+        self._take(rest[:len(rest) - hold])
+        self._carry = rest[len(rest) - hold:]
+        return False
+
+    def _take(self, text: str):
+        if self._block is not None:
+            self._block.append(text)
+
+    def finish(self) -> str:
+        """The extracted code: the first non-empty fenced block, else the fallback's pick."""
+        if self.code is not None:
+            return self.code
+        self._take(self._carry)
+        self._carry = ""
+        if self._block is not None:
+            # An unclosed fence at the end still counts as a block.
+            code, self._block = _block_code("".join(self._block)), None
+            if code:
+                self.code = code
+                return code
+        return self.fallback("".join(self._parts).strip())
+
+
+def extract_code(content: str, backend: str="replicate") -> str:
+    """Extract code from a complete completion using the backend's fallback heuristic."""
+    extractor = CodeExtractor(FALLBACKS[backend])
+    extractor.feed(content)
+    return extractor.finish()
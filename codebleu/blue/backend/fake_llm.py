@@ -0,0 +1,292 @@
+"""Local stand-in for the Replicate predictions and Ollama generate APIs, for tests and offline runs.
+
+    python -m fake_llm --port 18000 --latency 2
+    set REPLICATE_URL=http://127.0.0.1:18000/v1/predictions
+    set REPLICATE_API_TOKEN=fake
+    set OLLAMA_URL=http://127.0.0.1:18000/api/generate
+
+Replicate: predictions move starting -> processing -> succeeded over their
+latency. Creation honours "Prefer: wait=N", GET returns the current state,
+POST .../cancel cancels, and predictions created with "stream": true expose an
+SSE stream URL that emits the output as it is "generated".
+
+Ollama: POST /api/generate streams NDJSON {"response", "done"} objects over
+the latency (or answers with one object for "stream": false), and GET
+/api/tags lists the model, which is what the health probe asks for.
+
+Each generation's latency is drawn from --latency-dist around --latency, a
+--error-rate fraction of generations fail with --error-status, --no-stream
+makes both protocols answer in one piece, and --shape picks what the
+completion looks like: a fenced block followed by prose, bare code, or code
+inside unfenced prose.
+"""
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_CODE = "def solution(a, b):\n    return a + b"
+OUTPUT_SHAPES = {
+    "fenced": f"```python\n{DEFAULT_CODE}\n```\nThis function adds two numbers.",
+    "bare": DEFAULT_CODE,
+    "prose": f"Sure! Here is the function:\n\n{DEFAULT_CODE}\n\nIt returns the sum of its arguments.",
+}
+DEFAULT_OUTPUT = OUTPUT_SHAPES["fenced"]
+LATENCY_DISTS = ("fixed", "uniform", "exponential", "lognormal")
+
+
+class FakeLLMConfig:
+    def __init__(self, latency: float=1.0, output: str=None, chunk_size: int=8, latency_dist: str="fixed",
+                 jitter: float=0.5, error_rate: float=0.0, error_status: int=500, stream: bool=True,
+                 shape: str="fenced", model: str="llama2", seed: int=None, retain: float=60.0):
+        """latency is the mean (median for lognormal); jitter is the relative spread for uniform and lognormal.
+
+        retain is how long a finished prediction can still be fetched before it is forgotten.
+        """
+        if latency_dist not in LATENCY_DISTS:
+            raise ValueError(f"latency_dist must be one of {', '.join(LATENCY_DISTS)}")
+        self.latency, self.chunk_size, self.latency_dist, self.jitter = latency, chunk_size, latency_dist, jitter
+        self.output = OUTPUT_SHAPES[shape] if output is None else output
+        self.error_rate, self.error_status, self.stream, self.model = error_rate, error_status, stream, model
+        self.retain = retain
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sample_latency(self) -> float:
+        with self._lock:
+            if self.latency_dist == "uniform":
+                return max(self.latency * (1 + self.jitter * (2 * self._rng.random() - 1)), 0.0)
+            if self.latency_dist == "exponential":
+                return self._rng.expovariate(1 / self.latency) if self.latency > 0 else 0.0
+            if self.latency_dist == "lognormal":
+                return self.latency * self._rng.lognormvariate(0, self.jitter)
+            return self.latency
+
+    def sample_error(self) -> bool:
+        with self._lock:
+            return self._rng.random() < self.error_rate
+
+    def chunks(self) -> list:
+        return [self.output[i:i + self.chunk_size] for i in range(0, len(self.output), self.chunk_size)]
+
+
+class Prediction:
+    def __init__(self, config: FakeLLMConfig, stream: bool):
+        self.id = uuid.uuid4().hex
+        self.created = time.monotonic()
+        self.latency = config.sample_latency()
+        self.chunks = config.chunks()
+        self.stream = stream and config.stream
+        self.canceled = None  # monotonic time of cancellation
+
+    def finished(self):
+        """Monotonic time the prediction reached a terminal status, or None while it is running."""
+        if self.canceled is not None:
+            return self.canceled
+        done = self.created + self.latency
+        return done if time.monotonic() >= done else None
+
+    def status(self) -> str:
+        if self.canceled is not None:
+            return "canceled"
+        elapsed = time.monotonic() - self.created
+        if elapsed >= self.latency:
+            return "succeeded"
+        return "starting" if elapsed < self.latency * 0.1 else "processing"
+
+    def to_json(self, base: str) -> dict:
+        status = self.status()
+        urls = {"get": f"{base}/v1/predictions/{self.id}", "cancel": f"{base}/v1/predictions/{self.id}/cancel"}
+        if self.stream:
+            urls["stream"] = f"{base}/v1/predictions/{self.id}/stream"
+        return {
+            "id": self.id,
+            "status": status,
+            "output": self.chunks if status == "succeeded" else None,
+            "error": None,
+            "urls": urls,
+        }
+
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "FakeLLM/1.0"
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def base(self) -> str:
+        return f"http://{self.headers.get('Host')}"
+
+    def _read_json(self) -> dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _send_json(self, status: int, body: dict):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _prediction(self, pred_id: str):
+        with self.server.lock:
+            return self.server.predictions.get(pred_id)
+
+    def do_POST(self):
+        parts = self.path.strip("/").split("/")
+        if parts == ["api", "generate"]:
+            return self._ollama_generate(self._read_json())
+        if parts == ["v1", "predictions"]:
+            body = self._read_json()
+            if self.server.config.sample_error():
+                return self._send_json(self.server.config.error_status, {"detail": "Injected failure."})
+            pred = Prediction(self.server.config, bool(body.get("stream")))
+            self.server.add(pred)
+            prefer = self.headers.get("Prefer", "")
+            if prefer.startswith("wait"):
+                wait = float(prefer.partition("=")[2] or 60)
+                time.sleep(max(min(wait, pred.latency - (time.monotonic() - pred.created)), 0))
+            return self._send_json(201, pred.to_json(self.base))
+        if len(parts) == 4 and parts[:2] == ["v1", "predictions"] and parts[3] == "cancel":
+            pred = self._prediction(parts[2])
+            if pred is None:
+                return self._send_json(404, {"detail": "Not found."})
+            if pred.status() not in ("succeeded", "failed", "canceled"):
+                pred.canceled = time.monotonic()
+            return self._send_json(200, pred.to_json(self.base))
+        self._send_json(404, {"detail": "Not found."})
+
+    def do_GET(self):
+        parts = self.path.strip("/").split("/")
+        if parts == ["api", "tags"]:
+            return self._send_json(200, {"models": [{"name": self.server.config.model}]})
+        if len(parts) >= 3 and parts[:2] == ["v1", "predictions"]:
+            pred = self._prediction(parts[2])
+            if pred is None:
+                return self._send_json(404, {"detail": "Not found."})
+            if len(parts) == 4 and parts[3] == "stream":
+                return self._stream(pred)
+            return self._send_json(200, pred.to_json(self.base))
+        self._send_json(404, {"detail": "Not found."})
+
+    def _stream(self, pred: Prediction):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        gap = pred.latency / max(len(pred.chunks), 1)
+        try:
+            for chunk in pred.chunks:
+                if pred.canceled is not None:
+                    break
+                time.sleep(gap)
+                data = "".join(f"data: {line}\n" for line in chunk.split("\n"))
+                self._write_chunk(f"event: output\n{data}\n")
+            else:
+                self._write_chunk("event: done\ndata: {}\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            if pred.finished() is None:
+                pred.canceled = time.monotonic()
+            self.close_connection = True
+
+    def _ollama_generate(self, body: dict):
+        config = self.server.config
+        latency = config.sample_latency()
+        if config.sample_error():
+            time.sleep(latency)
+            return self._send_json(config.error_status, {"error": "injected failure"})
+        model = body.get("model", config.model)
+        if not (body.get("stream", True) and config.stream):
+            time.sleep(latency)
+            return self._send_json(200, {"model": model, "response": config.output, "done": True})
+        chunks = config.chunks()
+        gap = latency / max(len(chunks), 1)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for chunk in chunks:
+                time.sleep(gap)
+                self._write_chunk(json.dumps({"model": model, "response": chunk, "done": False}) + "\n")
+            self._write_chunk(json.dumps({"model": model, "response": "", "done": True}) + "\n")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def _write_chunk(self, text: str):
+        data = text.encode()
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+
+class FakeLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, config: FakeLLMConfig):
+        super().__init__(address, FakeLLMHandler)
+        self.config = config
+        self.predictions = {}
+        self.lock = threading.Lock()
+        self._pruned = time.monotonic()
+
+    def add(self, pred: Prediction):
+        """Register a prediction; those finished more than config.retain ago are dropped (at most once a second)."""
+        now = time.monotonic()
+        with self.lock:
+            self.predictions[pred.id] = pred
+            if now - self._pruned < 1.0:
+                return
+            self._pruned = now
+            expired = [pid for pid, p in self.predictions.items()
+                       if p.finished() is not None and now - p.finished() > self.config.retain]
+            for pid in expired:
+                del self.predictions[pid]
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up mid-stream or on keep-alive is expected, not an error.
+        if not isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            super().handle_error(request, client_address)
+
+
+def start_server(host: str="127.0.0.1", port: int=0, **config) -> FakeLLMServer:
+    """Start a server on a background thread; port 0 picks a free port (see server_address)."""
+    server = FakeLLMServer((host, port), FakeLLMConfig(**config))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m fake_llm", description="Fake Replicate and Ollama server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18000)
+    parser.add_argument("--latency", type=float, default=1.0, help="mean seconds per generation (median for lognormal)")
+    parser.add_argument("--latency-dist", choices=LATENCY_DISTS, default="fixed")
+    parser.add_argument("--jitter", type=float, default=0.5, help="relative spread for uniform, sigma for lognormal")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of generations that fail")
+    parser.add_argument("--error-status", type=int, default=500, help="HTTP status of injected failures")
+    parser.add_argument("--no-stream", dest="stream", action="store_false", help="answer in one piece, never streamed")
+    parser.add_argument("--chunk-size", type=int, default=8, help="characters per streamed chunk")
+    parser.add_argument("--shape", choices=sorted(OUTPUT_SHAPES), default="fenced", help="shape of the completion")
+    parser.add_argument("--output", help="completion text every generation returns (overrides --shape)")
+    parser.add_argument("--model", default="llama2", help="model name reported by /api/tags")
+    parser.add_argument("--seed", type=int, help="seed for latency and error sampling")
+    parser.add_argument("--retain", type=float, default=60.0, help="seconds a finished prediction stays fetchable")
+    args = parser.parse_args(argv)
+    config = FakeLLMConfig(args.latency, args.output, args.chunk_size, args.latency_dist, args.jitter, args.error_rate,
+                           args.error_status, args.stream, args.shape, args.model, args.seed, args.retain)
+    server = FakeLLMServer((args.host, args.port), config)
+    print(f"Fake LLM server on http://{args.host}:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""CodeBLEU for files too large to hold in memory as text and token lists.
+
+    python -m file_eval reference.py candidate.py --language python
+
+Each file is memory-mapped and decoded in fixed-size chunks. Chunks are
+tokenized with the evaluator's regex; a token that might continue into the
+next chunk is carried over rather than emitted, so the token stream is
+exactly that of the whole text. N-gram counts are accumulated chunk by chunk
+with the last MAX_ORDER - 1 tokens as context, so peak memory is bounded by
+the n-gram vocabulary rather than the file size. Scores match
+compute_codebleu_detailed on the decoded text.
+
+SyntaxMatch needs a parse tree of the whole text, so when it is wanted (see
+score_profiles) it is only computed if both files are at most
+FILE_SYNTAX_LIMIT bytes; above that it is left out.
+"""
+import argparse
+import codecs
+import json
+import mmap
+import os
+import sys
+from collections import Counter
+
+from evaluator import MAX_ORDER, MULTI_CHAR_OPS, _TOKEN_RE, CodeProfile, classify_vocab, score_profiles
+
+FILE_CHUNK_SIZE = int(os.environ.get("FILE_CHUNK_SIZE", str(1 << 20)))
+FILE_SYNTAX_LIMIT = int(os.environ.get("FILE_SYNTAX_LIMIT", str(4 << 20)))
+
+# The regex looks at most this many characters past a token's start (the
+# longest operator), and one past a word's end, to decide where it stops.
+_LOOKAHEAD = max(map(len, MULTI_CHAR_OPS))
+
+
+def read_text(path: str) -> str:
+    """The whole file as the in-memory path would see it."""
+    with open(path, encoding="utf-8", errors="replace") as f:
+        return f.read()
+
+
+def _split_tokens(buf: str, final: bool):
+    """Tokens of buf that later text cannot change, and the remainder to carry over."""
+    tokens, limit = [], len(buf)
+    for m in _TOKEN_RE.finditer(buf):
+        if not final and (m.end() >= limit or m.start() + _LOOKAHEAD > limit):
+            return tokens, buf[m.start():]
+        tokens.append(sys.intern(m.group()))
+    return tokens, ""
+
+
+def iter_token_chunks(path: str, chunk_size: int=FILE_CHUNK_SIZE):
+    """Yield the file's tokens as lists, one per chunk of chunk_size bytes."""
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+            carry = ""
+            for offset in range(0, size, chunk_size):
+                final = offset + chunk_size >= size
+                tokens, carry = _split_tokens(carry + decoder.decode(mm[offset:offset + chunk_size], final), final)
+                yield tokens
+
+
+class FileProfile(CodeProfile):
+    """A CodeProfile built from streamed tokens; holds counts, not the text or token list."""
+    __slots__ = ("path", "length")
+
+    def __init__(self, path: str, language: str="python", chunk_size: int=FILE_CHUNK_SIZE):
+        self.path, self.language = path, language
+        self.text = self.tokens = None
+        ngrams = [None] + [Counter() for _ in range(MAX_ORDER)]
+        context, length = [], 0
+        for chunk in iter_token_chunks(path, chunk_size):
+            length += len(chunk)
+            for n in range(1, MAX_ORDER + 1):
+                seq = context[max(len(context) - n + 1, 0):] + chunk
+                ngrams[n].update(zip(*(seq[i:] for i in range(n))))
+            context = (context + chunk)[-(MAX_ORDER - 1):]
+        self.length = length
+        self.vocab = Counter({ng[0]: c for ng, c in ngrams[1].items()})
+        self.ops, self.braces, self.identifiers, self.keywords = classify_vocab(self.vocab, language)
+        self._ngrams, self._subtrees = ngrams, None
+
+    @property
+    def subtrees(self):
+        """Subtree counts as for CodeProfile, or None above FILE_SYNTAX_LIMIT bytes."""
+        if self._subtrees is None and os.path.getsize(self.path) <= FILE_SYNTAX_LIMIT:
+            from syntax_match import subtree_counts
+            self._subtrees = subtree_counts(read_text(self.path), self.language)
+        return self._subtrees
+
+    def __len__(self):
+        return self.length
+
+
+def compute_codebleu_files(reference_path: str, candidate_path: str, language: str="python",
+                           chunk_size: int=FILE_CHUNK_SIZE) -> dict:
+    """compute_codebleu_detailed for two files, in memory bounded by their n-gram vocabularies."""
+    ref = FileProfile(reference_path, language, chunk_size)
+    cand = FileProfile(candidate_path, language, chunk_size)
+    return score_profiles(ref, cand, language, engine="counter")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m file_eval", description="Score two source files with CodeBLEU.")
+    parser.add_argument("reference")
+    parser.add_argument("candidate")
+    parser.add_argument("--language", default="python")
+    parser.add_argument("--chunk-size", type=int, default=FILE_CHUNK_SIZE, help="bytes decoded and tokenized at a time")
+    args = parser.parse_args(argv)
+    result = compute_codebleu_files(args.reference, args.candidate, args.language.lower().strip(), args.chunk_size)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""On-disk cache of LLM generations, keyed by prompt, language, model and sampling parameters.
+
+Generations run at temperature 0.0, so a repeated benchmark prompt can be
+answered from SQLite instead of the backend. Entries expire after a TTL and
+the least recently used ones are evicted once the table passes max_entries.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+GEN_CACHE_PATH = os.environ.get("GEN_CACHE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "generation_cache.sqlite3"))
+GEN_CACHE_TTL = float(os.environ.get("GEN_CACHE_TTL", str(7 * 24 * 3600)))
+GEN_CACHE_MAX_ENTRIES = int(os.environ.get("GEN_CACHE_MAX_ENTRIES", "10000"))
+
+
+def normalize_prompt(prompt: str) -> str:
+    return " ".join(prompt.split())
+
+
+def cache_key(backend: str, model: str, language: str, prompt: str, params: dict) -> str:
+    material = json.dumps([backend, model, language.strip().lower(), normalize_prompt(prompt), params], sort_keys=True)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class GenerationCache:
+    def __init__(self, path: str=GEN_CACHE_PATH, ttl: float=GEN_CACHE_TTL, max_entries: int=GEN_CACHE_MAX_ENTRIES):
+        self.path, self.ttl, self.max_entries = path, ttl, max_entries
+        self.hits = self.misses = self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS generations ("
+            " key TEXT PRIMARY KEY, body TEXT NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS generations_last_used ON generations(last_used)")
+
+    def get(self, key: str):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT body, created FROM generations WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                if row is not None:
+                    self._conn.execute("DELETE FROM generations WHERE key = ?", (key,))
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE generations SET last_used = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, body: str):
+        now = time.time()
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO generations VALUES (?, ?, ?, ?)", (key, body, now, now))
+            self._evict(now)
+
+    def _evict(self, now: float):
+        self._conn.execute("DELETE FROM generations WHERE created < ?", (now - self.ttl,))
+        excess = self._conn.execute("SELECT COUNT(*) FROM generations").fetchone()[0] - self.max_entries
+        if excess > 0:
+            self._conn.execute(
+                "DELETE FROM generations WHERE key IN (SELECT key FROM generations ORDER BY last_used LIMIT ?)", (excess,)
+            )
+            self.evictions += excess
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM generations")
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM generations").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "entries": entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """Process-wide cache, or None when GEN_CACHE=0."""
+    global _cache
+    if os.environ.get("GEN_CACHE", "1") in ("0", "false", "False"):
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = GenerationCache()
+    return _cache
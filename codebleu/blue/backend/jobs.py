@@ -0,0 +1,201 @@
+"""Background generate-then-evaluate jobs, persisted in SQLite.
+
+A job is a batch of prompts, each with an optional reference. A fixed number
+of generation threads keeps the LLM backends busy while a separate scoring
+thread evaluates finished generations, so scoring overlaps with generation.
+Item state lives in SQLite, so a restarted server picks up where it left off:
+interrupted generations are retried and generated-but-unscored items are
+scored.
+"""
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+
+from llm import generate_code
+from result_store import get_store, result_key, score_stored
+
+JOBS_DB_PATH = os.environ.get("JOBS_DB_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "jobs.sqlite3"))
+JOBS_CONCURRENCY = int(os.environ.get("JOBS_CONCURRENCY", "4"))
+JOBS_SCORE_WORKERS = int(os.environ.get("JOBS_SCORE_WORKERS", "1"))
+# Start the runner when main.py starts, so unfinished jobs resume without waiting for a /jobs request.
+JOBS_AUTOSTART = os.environ.get("JOBS_AUTOSTART", "1") not in ("0", "false", "False")
+
+# Item states: pending -> generating -> generated -> done, or failed.
+PENDING, GENERATING, GENERATED, DONE, FAILED = "pending", "generating", "generated", "done", "failed"
+
+
+class JobStore:
+    def __init__(self, path: str=JOBS_DB_PATH):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, created REAL NOT NULL, language TEXT NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS job_items ("
+            " job_id TEXT NOT NULL, idx INTEGER NOT NULL, prompt TEXT NOT NULL, reference TEXT,"
+            " language TEXT NOT NULL, state TEXT NOT NULL, status INTEGER, code TEXT, error TEXT,"
+            " scores TEXT, updated REAL NOT NULL, PRIMARY KEY (job_id, idx));"
+            "CREATE INDEX IF NOT EXISTS job_items_state ON job_items(state);"
+        )
+
+    def create_job(self, items, language: str="python") -> str:
+        job_id, now = uuid.uuid4().hex, time.time()
+        rows = []
+        for idx, item in enumerate(items):
+            reference = item.get("reference")
+            rows.append((job_id, idx, str(item.get("prompt", "")).strip(),
+                         None if reference is None else str(reference),
+                         str(item.get("language", language)).lower().strip(), PENDING, now))
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.execute("INSERT INTO jobs VALUES (?, ?, ?)", (job_id, now, language))
+            self._conn.executemany(
+                "INSERT INTO job_items (job_id, idx, prompt, reference, language, state, updated)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self._conn.execute("COMMIT")
+        return job_id
+
+    def item(self, job_id: str, idx: int) -> dict:
+        with self._lock:
+            cur = self._conn.execute("SELECT * FROM job_items WHERE job_id = ? AND idx = ?", (job_id, idx))
+            row = cur.fetchone()
+            return dict(zip([c[0] for c in cur.description], row)) if row else None
+
+    def update(self, job_id: str, idx: int, **fields):
+        fields["updated"] = time.time()
+        if "scores" in fields and fields["scores"] is not None:
+            fields["scores"] = json.dumps(fields["scores"])
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock:
+            self._conn.execute(f"UPDATE job_items SET {assignments} WHERE job_id = ? AND idx = ?",
+                               (*fields.values(), job_id, idx))
+
+    def recover(self):
+        """Reset generations a previous process left half-done; return (to generate, to score)."""
+        with self._lock:
+            self._conn.execute("UPDATE job_items SET state = ? WHERE state = ?", (PENDING, GENERATING))
+            pending = self._conn.execute(
+                "SELECT job_id, idx FROM job_items WHERE state = ? ORDER BY updated", (PENDING,)).fetchall()
+            generated = self._conn.execute(
+                "SELECT job_id, idx FROM job_items WHERE state = ? ORDER BY updated", (GENERATED,)).fetchall()
+        return pending, generated
+
+    def status(self, job_id: str) -> dict:
+        with self._lock:
+            job = self._conn.execute("SELECT created, language FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if job is None:
+                return None
+            counts = dict(self._conn.execute(
+                "SELECT state, COUNT(*) FROM job_items WHERE job_id = ? GROUP BY state", (job_id,)).fetchall())
+        total = sum(counts.values())
+        finished = counts.get(DONE, 0) + counts.get(FAILED, 0)
+        return {
+            "job_id": job_id,
+            "created": job[0],
+            "language": job[1],
+            "total": total,
+            "counts": {state: counts.get(state, 0) for state in (PENDING, GENERATING, GENERATED, DONE, FAILED)},
+            "finished": finished == total,
+        }
+
+    def results(self, job_id: str) -> list:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT idx, prompt, language, state, status, code, error, scores FROM job_items"
+                " WHERE job_id = ? ORDER BY idx", (job_id,)).fetchall()
+        return [
+            {"index": idx, "prompt": prompt, "language": language, "state": state, "status": status,
+             "code": code, "error": error, "scores": json.loads(scores) if scores else None}
+            for idx, prompt, language, state, status, code, error, scores in rows
+        ]
+
+
+class JobRunner:
+    """Generation threads feeding a scoring thread, both driven off the JobStore."""
+
+    def __init__(self, store: JobStore, generate=generate_code, concurrency: int=JOBS_CONCURRENCY,
+                 score_workers: int=JOBS_SCORE_WORKERS):
+        self.store, self.generate = store, generate
+        self.concurrency, self.score_workers = concurrency, score_workers
+        self._generate_queue, self._score_queue = queue.Queue(), queue.Queue()
+        self._started = False
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        with self._start_lock:
+            if self._started:
+                return
+            pending, generated = self.store.recover()
+            for key in pending:
+                self._generate_queue.put(key)
+            for key in generated:
+                self._score_queue.put(key)
+            for i in range(self.concurrency):
+                threading.Thread(target=self._generate_worker, name=f"job-gen-{i}", daemon=True).start()
+            for i in range(self.score_workers):
+                threading.Thread(target=self._score_worker, name=f"job-score-{i}", daemon=True).start()
+            self._started = True
+
+    def submit(self, items, language: str="python") -> str:
+        self.start()
+        job_id = self.store.create_job(items, language)
+        for idx in range(len(items)):
+            self._generate_queue.put((job_id, idx))
+        return job_id
+
+    def _generate_worker(self):
+        while True:
+            job_id, idx = self._generate_queue.get()
+            item = self.store.item(job_id, idx)
+            if item is None or item["state"] != PENDING:
+                continue
+            self.store.update(job_id, idx, state=GENERATING)
+            try:
+                status, body = self.generate(item["language"], item["prompt"])
+            except Exception as e:
+                status, body = 502, f"{type(e).__name__}: {e}"
+            if status != 200:
+                self.store.update(job_id, idx, state=FAILED, status=status, error=body)
+            elif item["reference"] is None:
+                self.store.update(job_id, idx, state=DONE, status=status, code=body)
+            else:
+                self.store.update(job_id, idx, state=GENERATED, status=status, code=body)
+                self._score_queue.put((job_id, idx))
+
+    def _score_worker(self):
+        while True:
+            job_id, idx = self._score_queue.get()
+            item = self.store.item(job_id, idx)
+            if item is None or item["state"] != GENERATED:
+                continue
+            if item["reference"] is None:
+                self.store.update(job_id, idx, state=DONE)
+                continue
+            try:
+                key = result_key(item["reference"], item["code"], item["language"])
+                scores = score_stored(item["reference"], item["code"], item["language"], key)
+                if get_store() is not None:
+                    get_store().record_many([(key, {"prompt": item["prompt"], "run": job_id})])
+                self.store.update(job_id, idx, state=DONE, scores=scores)
+            except Exception as e:
+                self.store.update(job_id, idx, state=FAILED, error=f"{type(e).__name__}: {e}")
+
+
+_runner = None
+_runner_lock = threading.Lock()
+
+
+def get_runner() -> JobRunner:
+    """Process-wide runner; started at server startup (see JOBS_AUTOSTART) or on first use, resuming unfinished jobs."""
+    global _runner
+    if _runner is None:
+        with _runner_lock:
+            if _runner is None:
+                runner = JobRunner(JobStore())
+                runner.start()
+                _runner = runner
+    return _runner
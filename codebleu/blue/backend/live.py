@@ -0,0 +1,243 @@
+"""Live scoring sessions: a candidate that is edited in place and rescored incrementally.
+
+A session holds one reference profile and the candidate's n-gram counts,
+operator/brace histograms and identifier multiset together with the running
+sums the scores are computed from. An edit replaces a character range; only
+the tokens around it are re-tokenized, and only the n-grams that touch those
+tokens are removed and re-added, so rescoring costs O(edit) rather than
+O(file). Scores match compute_codebleu_detailed on the edited text.
+
+Candidate tokens are kept in a gap buffer: tokens before the last edit store
+their offset from the start of the text, tokens after it (in reverse order)
+their offset from the end, so an edit shifts nothing and moving the gap costs
+only the distance between consecutive edits.
+"""
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+
+import evaluator
+from evaluator import (LANG_KEYWORDS, MAX_ORDER, _SYNTAX_BRACE_SET, _SYNTAX_OP_SET, _TOKEN_RE, _bleu_from_stats,
+                       _keyword_from_stats, _report, get_profile, ngram_counts)
+from metrics import EVAL_STAGE_SECONDS, timed
+
+LIVE_SESSIONS_MAX = int(os.environ.get("LIVE_SESSIONS_MAX", "256"))
+LIVE_SESSION_TTL = float(os.environ.get("LIVE_SESSION_TTL", "1800"))
+
+
+class LiveSession:
+    def __init__(self, reference: str, candidate: str="", language: str="python"):
+        self.id = uuid.uuid4().hex
+        self.language = language
+        self.reference = get_profile(reference, language)
+        self.keywords = LANG_KEYWORDS.get(language, set())
+        self.lock = threading.Lock()
+        self.touched = time.monotonic()
+        self.set_text(candidate)
+
+    def set_text(self, text: str):
+        """Replace the whole candidate and rebuild every count from scratch."""
+        self.version = 0
+        self.text = text
+        self._head = [(m.start(), sys.intern(m.group())) for m in _TOKEN_RE.finditer(text)]
+        self._tail = []
+        self._ngrams = [None] + [Counter() for _ in range(MAX_ORDER)]
+        self._orders = [None] + [[0, 0, 0, 0] for _ in range(MAX_ORDER)]  # clip, total, kw clip, kw total
+        self._ops, self._braces, self._identifiers = Counter(), Counter(), Counter()
+        # [intersection, union] of the candidate and reference histograms
+        self._ops_sums = [0, sum(self.reference.ops.values())]
+        self._braces_sums = [0, sum(self.reference.braces.values())]
+        self._id_overlap, self._id_union = 0, len(self.reference.identifiers)
+
+        tokens = [tok for _, tok in self._head]
+        for tok, c in Counter(tokens).items():
+            self._bump_token(tok, c)
+        for n in range(1, MAX_ORDER + 1):
+            counts, ref, stats = ngram_counts(tokens, n), self.reference.ngrams[n], self._orders[n]
+            for ng, c in counts.items():
+                m = min(c, ref.get(ng, 0))
+                stats[0] += m
+                stats[1] += c
+                if self.keywords and any(tok in self.keywords for tok in ng):
+                    stats[2] += m
+                    stats[3] += c
+            self._ngrams[n] = counts
+
+    def apply(self, start: int, end: int, text: str):
+        """Replace self.text[start:end] with text, updating counts around the edit only."""
+        old_len = len(self.text)
+        if not 0 <= start <= end <= old_len:
+            raise ValueError(f"edit range {start}:{end} outside text of length {old_len}")
+        new_text = self.text[:start] + text + self.text[end:]
+        new_len, edit_end = len(new_text), start + len(text)
+        head, tail = self._head, self._tail
+
+        # Move the gap so head holds only tokens ending before the edit, less one
+        # more, since a token that ends just before it may merge with new text.
+        while tail and old_len - tail[-1][0] + len(tail[-1][1]) < start:
+            fe, tok = tail.pop()
+            head.append((old_len - fe, tok))
+        while head and head[-1][0] + len(head[-1][1]) >= start:
+            pos, tok = head.pop()
+            tail.append((old_len - pos, tok))
+        if head:
+            pos, tok = head.pop()
+            tail.append((old_len - pos, tok))
+
+        # Re-tokenize from the gap until the scan lines up with an old token past
+        # the edit; from there on both texts, and so both token streams, agree.
+        anchor = head[-1][0] + len(head[-1][1]) if head else 0
+        removed, inserted = [], []
+        for m in _TOKEN_RE.finditer(new_text, anchor):
+            pos = m.start()
+            if pos >= edit_end:
+                fe = new_len - pos
+                while tail and tail[-1][0] > fe:
+                    removed.append(tail.pop()[1])
+                if tail and tail[-1][0] == fe:
+                    break
+            inserted.append((pos, sys.intern(m.group())))
+        else:
+            removed.extend(tok for _, tok in reversed(tail))
+            tail.clear()
+
+        left = [tok for _, tok in head[-(MAX_ORDER - 1):]]
+        right = [tok for _, tok in tail[:-MAX_ORDER:-1]]
+        added = [tok for _, tok in inserted]
+        head.extend(inserted)
+        self.text = new_text
+
+        for tok in removed:
+            self._bump_token(tok, -1)
+        for tok in added:
+            self._bump_token(tok, 1)
+        for middle, d in ((removed, -1), (added, 1)):
+            window = left + middle + right
+            for n in range(1, MAX_ORDER + 1):
+                # n-grams lying wholly inside the unchanged context are unaffected.
+                for i in range(max(len(left) - n + 1, 0), min(len(left) + len(middle), len(window) - n + 1)):
+                    self._bump_ngram(n, tuple(window[i:i+n]), d)
+        self.version += 1
+
+    def _bump_ngram(self, n: int, ng: tuple, d: int):
+        counts = self._ngrams[n]
+        c = counts.get(ng, 0)
+        r = self.reference.ngrams[n].get(ng, 0)
+        stats = self._orders[n]
+        clip = min(c + d, r) - min(c, r)
+        stats[0] += clip
+        stats[1] += d
+        if self.keywords and any(tok in self.keywords for tok in ng):
+            stats[2] += clip
+            stats[3] += d
+        if c + d:
+            counts[ng] = c + d
+        else:
+            del counts[ng]
+
+    def _bump_token(self, tok: str, d: int):
+        if tok in _SYNTAX_OP_SET:
+            _bump_histogram(self._ops, self._ops_sums, self.reference.ops, tok, d)
+        elif tok in _SYNTAX_BRACE_SET:
+            _bump_histogram(self._braces, self._braces_sums, self.reference.braces, tok, d)
+        elif tok not in self.keywords and tok.isidentifier():
+            c = self._identifiers[tok]
+            if c == 0 or c + d == 0:
+                sign = 1 if c == 0 else -1
+                if tok in self.reference.identifiers:
+                    self._id_overlap += sign
+                else:
+                    self._id_union += sign
+            if c + d:
+                self._identifiers[tok] = c + d
+            else:
+                del self._identifiers[tok]
+
+    def __len__(self):
+        return len(self._head) + len(self._tail)
+
+    def scores(self) -> dict:
+        orders = [tuple(stats) for stats in self._orders[1:]]
+        ratio = lambda sums: sums[0] / sums[1] if sums[1] > 0 else 0.0
+        bleu = _bleu_from_stats(orders, len(self), len(self.reference))
+        kw = _keyword_from_stats(orders)
+        syn = 0.5*ratio(self._ops_sums) + 0.5*ratio(self._braces_sums)
+        penalty = self._id_overlap / max(self._id_union, 1)
+        match = None
+        if evaluator.SYNTAX_COMPONENT == "ast":
+            # Parsing is not incremental; it only runs when SyntaxMatch feeds FinalScore.
+            from syntax_match import subtree_counts, syntax_match
+            match = syntax_match(subtree_counts(self.text, self.language), self.reference.subtrees)
+        return _report(bleu, kw, syn, penalty, match)
+
+    def edit(self, version: int, edits) -> dict:
+        """Apply [{"start", "end", "text"}] edits made against `version`; return fresh scores."""
+        with self.lock, timed(EVAL_STAGE_SECONDS, stage="live_edit"):
+            if version != self.version:
+                raise VersionConflict(self.version)
+            for e in edits:
+                self.apply(int(e.get("start", 0)), int(e.get("end", 0)), str(e.get("text", "")))
+            self.touched = time.monotonic()
+            return self.scores()
+
+
+def _bump_histogram(counts: Counter, sums: list, reference: Counter, key: str, d: int):
+    a, b = counts.get(key, 0), reference.get(key, 0)
+    sums[0] += min(a + d, b) - min(a, b)
+    sums[1] += max(a + d, b) - max(a, b)
+    if a + d:
+        counts[key] = a + d
+    else:
+        del counts[key]
+
+
+class VersionConflict(Exception):
+    """The client's edits were made against a different version of the candidate."""
+
+    def __init__(self, version: int):
+        super().__init__(f"session is at version {version}")
+        self.version = version
+
+
+class LiveSessionStore:
+    """Sessions by id, bounded in number and expired after LIVE_SESSION_TTL idle seconds."""
+
+    def __init__(self, max_sessions: int=LIVE_SESSIONS_MAX, ttl: float=LIVE_SESSION_TTL):
+        self.max_sessions, self.ttl = max_sessions, ttl
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def create(self, reference: str, candidate: str="", language: str="python") -> LiveSession:
+        session = LiveSession(reference, candidate, language)
+        with self._lock:
+            self._sessions[session.id] = session
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        return session
+
+    def get(self, session_id: str):
+        now = time.monotonic()
+        with self._lock:
+            for sid in [sid for sid, s in self._sessions.items() if now - s.touched > self.ttl]:
+                del self._sessions[sid]
+            session = self._sessions.get(session_id)
+            if session is not None:
+                self._sessions.move_to_end(session_id)
+            return session
+
+    def drop(self, session_id: str):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+_store = LiveSessionStore()
+
+
+def get_sessions() -> LiveSessionStore:
+    return _store
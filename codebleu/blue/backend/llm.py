@@ -0,0 +1,539 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from extract import FALLBACKS as EXTRACT_FALLBACKS, CodeExtractor, extract_code
+from gen_cache import cache_key, get_cache
+from metrics import EARLY_STOPS, EXTRACT_SECONDS, FALLBACKS, UPSTREAM_SECONDS, record, timed
+from router import BackendRouter, LLM_PROBE_INTERVAL
+
+REPLICATE_URL = os.environ.get("REPLICATE_URL", "https://api.replicate.com/v1/predictions")
+REPLICATE_DEFAULT_VERSION = "meta/llama-2-7b-chat:13c3cdee13ee059ab779f0291d29f1c2684a2ef8fb3fe2cfe2993c3a765db8de"
+REPLICATE_PARAMS = {"max_tokens": 1600, "temperature": 0.0, "top_p": 1.0}
+OLLAMA_PARAMS = {"max_tokens": 1600, "temperature": 0.0}
+
+# Prediction lifecycle: optional synchronous wait (Prefer: wait, max 60 s),
+# then polling with exponential backoff until a terminal status or timeout.
+REPLICATE_WAIT = int(os.environ.get("REPLICATE_WAIT", "0"))
+REPLICATE_TIMEOUT = float(os.environ.get("REPLICATE_TIMEOUT", "300"))
+REPLICATE_POLL_INITIAL = float(os.environ.get("REPLICATE_POLL_INITIAL", "0.5"))
+REPLICATE_POLL_MAX = float(os.environ.get("REPLICATE_POLL_MAX", "5"))
+REPLICATE_MAX_INFLIGHT = int(os.environ.get("REPLICATE_MAX_INFLIGHT", "8"))
+REPLICATE_TERMINAL = ("succeeded", "failed", "canceled")
+
+LLM_POOL_SIZE = int(os.environ.get("LLM_POOL_SIZE", "32"))
+# Connecting is fast when a backend is up; don't let a dead host hold a worker for the read timeout.
+LLM_CONNECT_TIMEOUT = float(os.environ.get("LLM_CONNECT_TIMEOUT", "3.05"))
+
+_session = None
+_session_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=LLM_POOL_SIZE, thread_name_prefix="llm")
+_replicate_slots = threading.BoundedSemaphore(REPLICATE_MAX_INFLIGHT)
+
+
+def get_session() -> requests.Session:
+    """Shared keep-alive session so /generate reuses TCP/TLS connections."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=LLM_POOL_SIZE)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _session = session
+    return _session
+
+
+def is_valid_code(status: int, body: str) -> bool:
+    return status == 200 and bool(body.strip()) and body.strip() != "ERROR_NO_CODE"
+
+
+def call_hedged(language: str, prompt: str, primary, secondary, delay: float, admit_secondary=None):
+    """Run primary; if it has not produced valid code after delay seconds, race secondary.
+
+    Returns the first valid (status, body). A failed backend triggers the other
+    immediately. The loser is cancelled: dropped if it has not started, told
+    through the shared cancel event otherwise. admit_secondary(), if given, is
+    asked only when secondary is about to be submitted; False skips it.
+    """
+    started = time.monotonic()
+    cancel = threading.Event()
+    pending = {_executor.submit(primary, language, prompt, cancel=cancel)}
+    fallback_sent = False
+    last = (502, "No backend produced code")
+    while pending:
+        timeout = None if fallback_sent else max(delay - (time.monotonic() - started), 0)
+        done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            status, body = future.result()
+            if is_valid_code(status, body):
+                cancel.set()
+                for loser in pending:
+                    loser.cancel()
+                return status, body
+            last = (status, body)
+        if not fallback_sent and (done or time.monotonic() - started >= delay):
+            if admit_secondary is None or admit_secondary():
+                pending.add(_executor.submit(secondary, language, prompt, cancel=cancel))
+            fallback_sent = True
+    return last
+
+
+def use_ollama_enabled() -> bool:
+    return os.environ.get("USE_OLLAMA", "0") in ("1", "true", "True")
+
+
+def configured_backends(use_ollama: bool=None) -> list:
+    """Backends in configured preference order: local Ollama (when enabled), then Replicate."""
+    if use_ollama is None:
+        use_ollama = use_ollama_enabled()
+    return ["ollama", "replicate"] if use_ollama else ["replicate"]
+
+
+def _probe_ollama():
+    if not use_ollama_enabled():
+        return None
+    url = os.environ.get("OLLAMA_URL", "http://127.0.0.1:11434/api/generate")
+    r = get_session().get(url.rsplit("/api/", 1)[0] + "/api/tags", timeout=(LLM_CONNECT_TIMEOUT, 5))
+    return r.status_code < 500
+
+
+def _probe_replicate():
+    api_token = os.environ.get("REPLICATE_API_TOKEN")
+    if not api_token:
+        return None
+    r = get_session().get(REPLICATE_URL, headers={"Authorization": f"Token {api_token}"},
+                          timeout=(LLM_CONNECT_TIMEOUT, 10))
+    return r.status_code < 500 and r.status_code not in (401, 403)
+
+
+_router = None
+
+
+def get_router() -> BackendRouter:
+    """Process-wide router; its health probe thread starts on first use."""
+    global _router
+    if _router is None:
+        with _session_lock:
+            if _router is None:
+                router = BackendRouter({"ollama": _probe_ollama, "replicate": _probe_replicate})
+                router.start_probes(LLM_PROBE_INTERVAL)
+                _router = router
+    return _router
+
+
+def generate_code(language: str, prompt: str):
+    """Generate code with the healthiest available backend, failing over to the next; returns (status, body)."""
+    router = get_router()
+    names = router.order(configured_backends())
+    calls = {"ollama": call_ollama, "replicate": call_replicate}
+    hedge_delay = os.environ.get("LLM_HEDGE_DELAY")
+
+    last = (503, router.unavailable_message(configured_backends()))
+    previous = None
+    # Admit each backend right before calling it: admitting a half-open backend claims its one trial call,
+    # which only a call that reports back can release.
+    for i, name in enumerate(names):
+        if not router.admit(name):
+            continue
+        # Hedged mode — start the best backend, race the runner-up if it is slow
+        if hedge_delay and previous is None and i + 1 < len(names):
+            runner_up = names[i + 1]
+            return call_hedged(language, prompt, calls[name], calls[runner_up], float(hedge_delay),
+                               lambda: router.admit(runner_up))
+        if previous is not None:
+            FALLBACKS.inc(from_backend=previous, to_backend=name)
+        status, body = calls[name](language, prompt)
+        if status == 200:
+            return status, body
+        last, previous = (status, body), name
+    return last
+
+
+def _cached(backend: str, model: str, params: dict, fetch, language: str, prompt: str, cancel=None, sampling=None):
+    """Serve a generation from the on-disk cache, or fetch it and store valid code.
+
+    sampling ({"temperature", "seed"}) overrides the backend's default
+    parameters for this call and is part of the cache key.
+    """
+    cache = get_cache()
+    key = cache_key(backend, model, language, prompt, {**params, **(sampling or {})}) if cache else None
+    body = cache.get(key) if cache else None
+    if body is not None:
+        return 200, body
+    start = time.perf_counter()
+    status, body = fetch(language, prompt, cancel, sampling)
+    elapsed = time.perf_counter() - start
+    record(UPSTREAM_SECONDS, elapsed, f"upstream/{backend}", backend=backend, status=status)
+    get_router().record(backend, status, elapsed, None if status == 200 else body)
+    if cache and is_valid_code(status, body):
+        cache.put(key, body)
+    return status, body
+
+
+def call_replicate(language: str, prompt: str, cancel=None, sampling=None):
+    model_version = os.environ.get("REPLICATE_MODEL_VERSION", REPLICATE_DEFAULT_VERSION)
+    return _cached("replicate", model_version, REPLICATE_PARAMS, _fetch_replicate, language, prompt, cancel, sampling)
+
+
+def call_ollama(language: str, prompt: str, cancel=None, sampling=None):
+    model = os.environ.get("OLLAMA_MODEL", "llama2")
+    return _cached("ollama", model, OLLAMA_PARAMS, _fetch_ollama, language, prompt, cancel, sampling)
+
+
+def build_prompt(language: str, prompt: str) -> str:
+    system = (
+        f"You are an expert {language} programmer. ONLY output valid, runnable {language} source code. "
+        "Do NOT include explanations, markdown, or any extra text. If you cannot comply, output only ERROR_NO_CODE."
+    )
+    user = f"Task: {prompt}\n\nReturn only the code, nothing else."
+    return f"{system}\n\n{user}"
+
+
+def _replicate_request(language: str, prompt: str, stream: bool=False, sampling=None):
+    api_token = os.environ.get("REPLICATE_API_TOKEN")
+    model_version = os.environ.get("REPLICATE_MODEL_VERSION", REPLICATE_DEFAULT_VERSION)
+    payload = {
+        "version": model_version,
+        "input": {
+            "prompt": build_prompt(language, prompt),
+            **REPLICATE_PARAMS,
+            **(sampling or {}),
+        }
+    }
+    if stream:
+        payload["stream"] = True
+    headers = {
+        "Authorization": f"Token {api_token}",
+        "Content-Type": "application/json",
+    }
+    return payload, headers
+
+
+def _fetch_replicate(language: str, prompt: str, cancel=None, sampling=None):
+    api_token = os.environ.get("REPLICATE_API_TOKEN")
+    debug = os.environ.get("REPLICATE_DEBUG")
+
+    if not api_token:
+        return 401, "REPLICATE_API_TOKEN not set in environment"
+
+    if not REPLICATE_WAIT:
+        return _extract_stream("replicate", stream_replicate(language, prompt, cancel, sampling), cancel)
+
+    # Prefer: wait holds the create call until the output is complete, so there
+    # is nothing left to cut short; poll and extract from the full output.
+    payload, headers = _replicate_request(language, prompt, sampling=sampling)
+    headers["Prefer"] = f"wait={min(REPLICATE_WAIT, 60)}"
+
+    if not _replicate_slots.acquire(timeout=REPLICATE_TIMEOUT):
+        return 503, "Too many in-flight Replicate predictions"
+    try:
+        try:
+            r = get_session().post(REPLICATE_URL, json=payload, headers=headers, timeout=(LLM_CONNECT_TIMEOUT, 120))
+        except Exception as e:
+            if debug:
+                print("Replicate request failed:", e)
+            return 502, f"Replicate request failed: {e}"
+
+        if r.status_code not in (200, 201):
+            return r.status_code, r.text
+
+        try:
+            data = r.json()
+        except Exception:
+            return 502, "Failed to parse Replicate response"
+
+        status, data = _await_prediction(data, headers, cancel, debug)
+    finally:
+        _replicate_slots.release()
+    if status != 200:
+        return status, data
+
+    output = data.get("output")
+    content = ("".join(output) if isinstance(output, list) else str(output or "")).strip()
+
+    if debug:
+        print("Replicate response:", content[:200])
+
+    with timed(EXTRACT_SECONDS, "extract", backend="replicate"):
+        return 200, extract_code(content, "replicate")
+
+
+def _extract_stream(backend: str, chunks, cancel=None):
+    """Feed a completion stream to a CodeExtractor; returns (status, code) like call_*.
+
+    The stream is closed as soon as the first complete code block has arrived,
+    which stops the upstream generation (see stream_replicate/stream_ollama).
+    """
+    debug = os.environ.get("REPLICATE_DEBUG")
+    extractor = CodeExtractor(EXTRACT_FALLBACKS[backend])
+    spent = 0.0
+    try:
+        for text in chunks:
+            if cancel is not None and cancel.is_set():
+                return 499, "Generation cancelled"
+            start = time.perf_counter()
+            done = extractor.feed(text)
+            spent += time.perf_counter() - start
+            if done:
+                EARLY_STOPS.inc(backend=backend)
+                break
+    except BackendError as e:
+        if debug:
+            print(f"{backend} stream failed:", e)
+        return e.status, str(e)
+    finally:
+        chunks.close()
+    start = time.perf_counter()
+    code = extractor.finish()
+    record(EXTRACT_SECONDS, spent + time.perf_counter() - start, "extract", backend=backend)
+    if debug:
+        print(f"{backend} code:", code[:200])
+    return 200, code
+
+
+def _cancel_prediction(data: dict, headers: dict):
+    cancel_url = (data.get("urls") or {}).get("cancel")
+    if cancel_url:
+        try:
+            get_session().post(cancel_url, headers={"Authorization": headers["Authorization"]}, timeout=10)
+        except Exception:
+            pass
+
+
+def _await_prediction(data: dict, headers: dict, cancel=None, debug=None):
+    """Poll a prediction until it reaches a terminal status; returns (status, prediction or message)."""
+    deadline = time.monotonic() + REPLICATE_TIMEOUT
+    delay = REPLICATE_POLL_INITIAL
+    get_url = (data.get("urls") or {}).get("get")
+    while data.get("status") not in REPLICATE_TERMINAL:
+        if not get_url:
+            return 502, "Replicate prediction has no polling URL"
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            _cancel_prediction(data, headers)
+            return 504, f"Replicate prediction {data.get('id')} timed out"
+        if cancel is None:
+            time.sleep(min(delay, remaining))
+        elif cancel.wait(min(delay, remaining)):
+            _cancel_prediction(data, headers)
+            return 499, "Generation cancelled"
+        delay = min(delay * 2, REPLICATE_POLL_MAX)
+        try:
+            r = get_session().get(get_url, headers={"Authorization": headers["Authorization"]}, timeout=30)
+        except Exception as e:
+            if debug:
+                print("Replicate poll failed:", e)
+            continue
+        if r.status_code != 200:
+            if r.status_code == 429 or r.status_code >= 500:
+                continue
+            return r.status_code, r.text
+        try:
+            data = r.json()
+        except Exception:
+            return 502, "Failed to parse Replicate response"
+        if debug:
+            print("Replicate prediction", data.get("id"), data.get("status"))
+    if data["status"] != "succeeded":
+        return 502, f"Replicate prediction {data['status']}: {data.get('error') or ''}".strip()
+    return 200, data
+
+
+def _ollama_request(language: str, prompt: str, stream: bool=False, sampling=None):
+    url = os.environ.get("OLLAMA_URL", "http://127.0.0.1:11434/api/generate")
+    model = os.environ.get("OLLAMA_MODEL", "llama2")
+    payload = {
+        "model": model,
+        "prompt": build_prompt(language, prompt),
+        **OLLAMA_PARAMS,
+        "stream": stream
+    }
+    if sampling:
+        # Ollama takes sampling parameters (temperature, seed) under "options".
+        payload["options"] = dict(sampling)
+    return url, payload
+
+
+def _fetch_ollama(language: str, prompt: str, cancel=None, sampling=None):
+    if cancel is not None and cancel.is_set():
+        return 499, "Generation cancelled"
+    return _extract_stream("ollama", stream_ollama(language, prompt, sampling), cancel)
+
+
+class BackendError(Exception):
+    """Raised by the streaming clients; carries the HTTP status like the (status, body) tuples."""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def _iter_lines(response, backend: str, **kwargs):
+    """response.iter_lines, with a body cut off or undecodable mid-stream raised as BackendError(502)."""
+    try:
+        yield from response.iter_lines(chunk_size=None, **kwargs)
+    except (requests.RequestException, ValueError) as e:
+        raise BackendError(502, f"{backend} stream failed: {e}")
+
+
+def stream_ollama(language: str, prompt: str, sampling=None):
+    """Yield completion text as Ollama produces it (NDJSON, one object per line)."""
+    url, payload = _ollama_request(language, prompt, stream=True, sampling=sampling)
+    try:
+        r = get_session().post(url, json=payload, timeout=(LLM_CONNECT_TIMEOUT, 120), stream=True)
+    except Exception as e:
+        raise BackendError(502, f"Ollama request failed: {e}")
+    with r:
+        if r.status_code != 200:
+            raise BackendError(r.status_code, r.text)
+        for line in _iter_lines(r, "Ollama"):
+            if not line:
+                continue
+            try:
+                data = json.loads(line)
+            except ValueError:
+                raise BackendError(502, "Failed to parse Ollama stream")
+            if data.get("error"):
+                raise BackendError(502, str(data["error"]))
+            if data.get("response"):
+                yield data["response"]
+            if data.get("done"):
+                return
+
+
+def _iter_sse(response):
+    """Parse a text/event-stream response into (event, data) pairs."""
+    event, data = "message", []
+    for line in _iter_lines(response, "Replicate", decode_unicode=True):
+        if line is None:
+            continue
+        if not line:
+            if data:
+                yield event, "\n".join(data)
+            event, data = "message", []
+        elif line.startswith("event:"):
+            event = line[6:].strip()
+        elif line.startswith("data:"):
+            data.append(line[6:] if line.startswith("data: ") else line[5:])
+    if data:
+        yield event, "\n".join(data)
+
+
+def stream_replicate(language: str, prompt: str, cancel=None, sampling=None):
+    """Yield completion text from a Replicate prediction created with stream=True.
+
+    Closing the generator early (the client disconnected, or the code block is
+    complete) cancels the prediction so it stops consuming Replicate capacity.
+    """
+    if not os.environ.get("REPLICATE_API_TOKEN"):
+        raise BackendError(401, "REPLICATE_API_TOKEN not set in environment")
+    payload, headers = _replicate_request(language, prompt, stream=True, sampling=sampling)
+    if not _replicate_slots.acquire(timeout=REPLICATE_TIMEOUT):
+        raise BackendError(503, "Too many in-flight Replicate predictions")
+    data, finished = {}, False
+    try:
+        try:
+            r = get_session().post(REPLICATE_URL, json=payload, headers=headers, timeout=(LLM_CONNECT_TIMEOUT, 120))
+        except Exception as e:
+            raise BackendError(502, f"Replicate request failed: {e}")
+        if r.status_code not in (200, 201):
+            raise BackendError(r.status_code, r.text)
+        try:
+            data = r.json()
+        except ValueError:
+            raise BackendError(502, "Failed to parse Replicate response")
+        stream_url = (data.get("urls") or {}).get("stream")
+        if not stream_url:
+            # Model without streaming support: wait for the complete output.
+            status, result = _await_prediction(data, headers, cancel)
+            finished = True
+            if status != 200:
+                raise BackendError(status, result)
+            output = result.get("output")
+            yield "".join(output) if isinstance(output, list) else str(output or "")
+            return
+        sse_headers = {"Authorization": headers["Authorization"], "Accept": "text/event-stream"}
+        try:
+            s = get_session().get(stream_url, headers=sse_headers, timeout=(LLM_CONNECT_TIMEOUT, 120), stream=True)
+        except requests.RequestException as e:
+            raise BackendError(502, f"Replicate stream failed: {e}")
+        with s:
+            if s.status_code != 200:
+                raise BackendError(s.status_code, s.text)
+            for event, text in _iter_sse(s):
+                if event == "output":
+                    yield text
+                elif event == "error":
+                    finished = True
+                    raise BackendError(502, text)
+                elif event == "done":
+                    finished = True
+                    return
+    finally:
+        if data and not finished:
+            _cancel_prediction(data, headers)
+        _replicate_slots.release()
+
+
+def stream_generation(language: str, prompt: str, use_ollama: bool):
+    """Yield ("token", text), then ("done", {...}) or ("error", {...}), trying backends in order.
+
+    A backend that fails before producing any text falls through to the next
+    one; one that fails midway ends the stream with an error. The upstream
+    stream is closed once the first code block is complete. Cached
+    generations are replayed as a single token.
+    """
+    available = {
+        "ollama": (os.environ.get("OLLAMA_MODEL", "llama2"), OLLAMA_PARAMS, stream_ollama),
+        "replicate": (os.environ.get("REPLICATE_MODEL_VERSION", REPLICATE_DEFAULT_VERSION), REPLICATE_PARAMS,
+                      stream_replicate),
+    }
+    router = get_router()
+    names = router.order(configured_backends(use_ollama))
+    backends = [(name, *available[name]) for name in names]
+    cache = get_cache()
+    error = {"status": 503, "error": router.unavailable_message(configured_backends(use_ollama))}
+    for i, (name, model, params, stream) in enumerate(backends):
+        key = cache_key(name, model, language, prompt, params) if cache else None
+        body = cache.get(key) if cache else None
+        if body is not None:
+            yield "token", body
+            yield "done", {"backend": name, "code": body, "cached": True}
+            return
+        if not router.admit(name):
+            continue
+        extractor = CodeExtractor(EXTRACT_FALLBACKS[name])
+        chunks, produced = stream(language, prompt), False
+        start = time.perf_counter()
+        try:
+            for text in chunks:
+                produced = True
+                yield "token", text
+                if extractor.feed(text):
+                    # The code block is complete; stop paying for the explanation after it.
+                    EARLY_STOPS.inc(backend=name)
+                    break
+        except BackendError as e:
+            router.record(name, e.status, time.perf_counter() - start, str(e))
+            error = {"status": e.status, "error": str(e), "backend": name}
+            if produced:
+                break
+            if i + 1 < len(backends):
+                FALLBACKS.inc(from_backend=name, to_backend=backends[i + 1][0])
+            continue
+        finally:
+            chunks.close()
+        router.record(name, 200, time.perf_counter() - start)
+        code = extractor.finish()
+        if cache and is_valid_code(200, code):
+            cache.put(key, code)
+        yield "done", {"backend": name, "code": code, "cached": False}
+        return
+    yield "error", error
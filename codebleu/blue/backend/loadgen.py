@@ -0,0 +1,193 @@
+"""Open-loop load generator for the Flask app: drives /generate, /evaluate and / at a target rate.
+
+    python -m fake_llm --port 18000 --latency 1 --latency-dist lognormal &
+    REPLICATE_URL=http://127.0.0.1:18000/v1/predictions REPLICATE_API_TOKEN=fake python main.py &
+    python -m loadgen http://127.0.0.1:8000 --rate 50 --duration 30 --mix generate=1,evaluate=4,index=1
+
+Requests are issued on a fixed schedule (rate per second, spread evenly),
+whether or not earlier ones have finished, and each latency is measured from
+its scheduled start; a server that falls behind therefore shows up in the
+percentiles instead of silently lowering the offered load. Prompts and
+evaluate pairs are drawn from --distinct pools, so a small pool exercises
+request coalescing and the generation cache, a large one defeats them.
+"""
+import argparse
+import json
+import math
+import random
+import statistics
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from bench import synthetic_code
+
+ENDPOINTS = ("generate", "evaluate", "index")
+PROMPTS = ("add two numbers", "reverse a string", "check whether a number is prime", "compute the nth fibonacci number",
+           "merge two sorted lists", "count the vowels in a string", "flatten a nested list", "find the maximum of a list")
+
+
+def parse_mix(spec: str) -> dict:
+    """"generate=1,evaluate=4" -> {"generate": 1.0, "evaluate": 4.0}."""
+    mix = {}
+    for part in filter(None, (p.strip() for p in spec.split(","))):
+        name, _, weight = part.partition("=")
+        if name not in ENDPOINTS:
+            raise ValueError(f"unknown endpoint {name!r}; expected one of {', '.join(ENDPOINTS)}")
+        mix[name] = float(weight or 1)
+    if not mix or sum(mix.values()) <= 0:
+        raise ValueError("mix needs at least one endpoint with a positive weight")
+    return mix
+
+
+def percentile(values, q: float) -> float:
+    """Nearest-rank percentile of sorted values."""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, math.ceil(q / 100 * len(values)) - 1))]
+
+
+class Workload:
+    """Request bodies for each endpoint, drawn reproducibly from fixed pools."""
+
+    def __init__(self, language: str="python", distinct: int=50, tokens: int=200, seed: int=0):
+        rng = random.Random(seed)
+        self.language = language
+        self.prompts = [f"{PROMPTS[i % len(PROMPTS)]} (variant {i})" for i in range(distinct)]
+        self.pairs = []
+        for _ in range(distinct):
+            reference = synthetic_code(language, tokens, rng)
+            tokens_out = reference.split(" ")
+            for i in rng.sample(range(len(tokens_out)), len(tokens_out) // 10):
+                tokens_out[i] = f"edit_{rng.randint(0, 9)}"
+            self.pairs.append((reference, " ".join(tokens_out)))
+
+    def request(self, endpoint: str, rng: random.Random):
+        """(method, path, json body) for one request."""
+        if endpoint == "generate":
+            return "POST", "/generate", {"language": self.language, "prompt": rng.choice(self.prompts)}
+        if endpoint == "evaluate":
+            reference, candidate = rng.choice(self.pairs)
+            return "POST", "/evaluate", {"language": self.language, "reference": reference, "candidate": candidate}
+        return "GET", "/", None
+
+
+def run(base_url: str, rate: float, duration: float, mix: dict, workload: Workload, concurrency: int=256,
+        timeout: float=120.0, seed: int=0) -> dict:
+    """Offer rate requests/second for duration seconds; return the report."""
+    rng = random.Random(seed)
+    names, weights = list(mix), list(mix.values())
+    plan = [rng.choices(names, weights)[0] for _ in range(int(rate * duration))]
+    local = threading.local()
+    results = {name: [] for name in names}   # (latency, status) per endpoint
+    lock = threading.Lock()
+
+    def session():
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        return local.session
+
+    def fire(endpoint: str, method: str, path: str, body, scheduled: float):
+        try:
+            status = session().request(method, base_url.rstrip("/") + path, json=body, timeout=timeout).status_code
+        except requests.RequestException as e:
+            status = type(e).__name__
+        latency = time.perf_counter() - scheduled
+        with lock:
+            results[endpoint].append((latency, status))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        for i, endpoint in enumerate(plan):
+            scheduled = start + i / rate
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(fire, endpoint, *workload.request(endpoint, rng), scheduled)
+    elapsed = time.perf_counter() - start
+    return report(results, elapsed, rate)
+
+
+def report(results: dict, elapsed: float, rate: float) -> dict:
+    out = {"offered_rate": rate, "elapsed_s": round(elapsed, 3), "endpoints": {}}
+    everything = []
+    for endpoint, samples in results.items():
+        everything.extend(samples)
+        out["endpoints"][endpoint] = summarize(samples, elapsed)
+    out["total"] = summarize(everything, elapsed)
+    return out
+
+
+def summarize(samples, elapsed: float) -> dict:
+    """Counts, throughput and latency percentiles.
+
+    Percentiles cover every request, failed or not: leaving out 429s and
+    timeouts would flatter the tail exactly when the server is overloaded.
+    Failures are also summarised on their own (error_*), since fast 429s and
+    slow timeouts pull the combined figures in opposite directions.
+    """
+    everything = sorted(latency for latency, _ in samples)
+    ok = [latency for latency, status in samples if status == 200]
+    errors = sorted(latency for latency, status in samples if status != 200)
+    ms = lambda values, q: round(percentile(values, q) * 1000, 2) if values else None
+    return {
+        "requests": len(samples),
+        "ok": len(ok),
+        "statuses": dict(Counter(str(status) for _, status in samples)),
+        "throughput_rps": round(len(ok) / elapsed, 2) if elapsed else 0.0,
+        "mean_ms": round(statistics.fmean(everything) * 1000, 2) if everything else None,
+        "p50_ms": ms(everything, 50),
+        "p95_ms": ms(everything, 95),
+        "p99_ms": ms(everything, 99),
+        "error_p50_ms": ms(errors, 50),
+        "error_p99_ms": ms(errors, 99),
+    }
+
+
+def print_table(result: dict):
+    print(f"offered {result['offered_rate']}/s over {result['elapsed_s']}s; percentiles include failed requests")
+    columns = ("p50_ms", "p95_ms", "p99_ms", "error_p50_ms", "error_p99_ms")
+    print(f"{'endpoint':<10} {'reqs':>7} {'ok':>7} {'rps':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} "
+          f"{'err p50':>9} {'err p99':>9}  statuses")
+    rows = list(result["endpoints"].items()) + [("total", result["total"])]
+    for name, s in rows:
+        cells = (s[k] if s[k] is not None else "-" for k in columns)
+        print(f"{name:<10} {s['requests']:>7} {s['ok']:>7} {s['throughput_rps']:>8} "
+              + " ".join(f"{c:>9}" for c in cells) + f"  {s['statuses']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m loadgen", description="Drive the CodeBLEU server at a fixed rate.")
+    parser.add_argument("url", nargs="?", default="http://127.0.0.1:8000", help="server base URL")
+    parser.add_argument("--rate", type=float, default=10.0, help="requests per second offered")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of load")
+    parser.add_argument("--mix", default="generate=1,evaluate=4,index=1", help="endpoint weights (generate, evaluate, index)")
+    parser.add_argument("--language", default="python")
+    parser.add_argument("--distinct", type=int, default=50, help="distinct prompts and evaluate pairs in the pools")
+    parser.add_argument("--tokens", type=int, default=200, help="approximate tokens per evaluate reference")
+    parser.add_argument("--concurrency", type=int, default=256, help="maximum requests outstanding")
+    parser.add_argument("--timeout", type=float, default=120.0, help="per-request timeout, seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args(argv)
+    if args.rate <= 0 or args.duration <= 0:
+        parser.error("--rate and --duration must be positive")
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+    workload = Workload(args.language, max(args.distinct, 1), args.tokens, args.seed)
+    result = run(args.url, args.rate, args.duration, mix, workload, args.concurrency, args.timeout, args.seed)
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_table(result)
+    return 0 if result["total"]["ok"] == result["total"]["requests"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
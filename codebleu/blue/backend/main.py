@@ -1,171 +1,149 @@
-from flask import Flask, request, Response, render_template, jsonify
-from evaluator import compute_codebleu_detailed
+from flask import Flask, g, request, Response, render_template, jsonify, stream_with_context
+from best_of import BEST_OF_MAX_N, DEFAULT_TEMPERATURE, generate_best_of
+from evaluator import batch_pair, compute_codebleu_corpus, profile_cache_stats
+from file_eval import compute_codebleu_files
+from llm import configured_backends, generate_code, get_router, stream_generation, use_ollama_enabled
+from gen_cache import get_cache, normalize_prompt
+from jobs import JOBS_AUTOSTART, get_runner
+from live import VersionConflict, get_sessions
+from result_store import get_store, labels_of, result_key, score_batch_stored, score_stored
+from singleflight import EVALUATE_MAX_INFLIGHT, GENERATE_MAX_INFLIGHT, Overloaded, SingleFlight, request_key
+import metrics
+import json
 import os
-import requests
+import tempfile
+import time
 
 app = Flask(__name__, template_folder="../frontend")
 
-REPLICATE_URL = "https://api.replicate.com/v1/predictions"
+# Identical concurrent /generate and /evaluate requests share one call.
+generate_flights = SingleFlight("/generate", GENERATE_MAX_INFLIGHT)
+evaluate_flights = SingleFlight("/evaluate", EVALUATE_MAX_INFLIGHT)
+
+
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
+    if request.args.get("timing") in ("1", "true"):
+        metrics.start_trace()
+
+
+@app.after_request
+def record_timing(response):
+    elapsed = time.perf_counter() - g.started
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    metrics.HTTP_SECONDS.observe(elapsed, route=route, method=request.method, status=response.status_code)
+    trace = metrics.end_trace()
+    if trace is not None:
+        trace["total"] = elapsed
+        response.headers["Server-Timing"] = ", ".join(
+            f"{name.replace('/', '-')};dur={seconds * 1000:.3f}" for name, seconds in trace.items())
+        if response.is_json and not response.is_streamed:
+            body = response.get_json()
+            if isinstance(body, dict):
+                body["Timing"] = {name: round(seconds * 1000, 3) for name, seconds in trace.items()}
+                response.set_data(app.json.dumps(body))
+    return response
+
+
+@app.errorhandler(Overloaded)
+def overloaded(e):
+    return jsonify({"error": str(e)}), 429, {"Retry-After": str(e.retry_after)}
+
+
+@metrics.register_collector
+def cache_gauges():
+    profiles = profile_cache_stats()
+    gauges = [
+        ("profile_cache_entries", "Cached CodeProfiles.", {(): profiles["entries"]}),
+        ("profile_cache_tokens", "Tokens held by cached CodeProfiles.", {(): profiles["tokens"]}),
+        ("profile_cache_lookups", "CodeProfile cache lookups by result.",
+         {(("result", "hit"),): profiles["hits"], (("result", "miss"),): profiles["misses"]}),
+        ("live_sessions", "Open live scoring sessions.", {(): len(get_sessions())}),
+        ("inflight_requests", "Distinct /generate and /evaluate calls in progress.",
+         {(("route", f.name),): len(f) for f in (generate_flights, evaluate_flights)}),
+    ]
+    backends = get_router().snapshot()
+    gauges.append(("llm_backend_circuit_open", "1 while a backend's circuit breaker is open.",
+                   {(("backend", name),): int(h["state"] == "open") for name, h in backends.items()}))
+    gauges.append(("llm_backend_failure_rate", "Failure rate over a backend's recent calls.",
+                   {(("backend", name),): h["failure_rate"] for name, h in backends.items()}))
+    cache = get_cache()
+    if cache is not None:
+        stats = cache.stats()
+        gauges.append(("generation_cache_entries", "Cached LLM generations.", {(): stats["entries"]}))
+        gauges.append(("generation_cache_lookups", "Generation cache lookups by result.",
+                       {(("result", "hit"),): stats["hits"], (("result", "miss"),): stats["misses"]}))
+        gauges.append(("generation_cache_evictions", "Generations evicted from the cache.", {(): stats["evictions"]}))
+    store = get_store()
+    if store is not None:
+        stats = store.stats()
+        gauges.append(("result_store_entries", "Stored evaluation results.", {(): stats["entries"]}))
+        gauges.append(("result_store_lookups", "Result store lookups by result.",
+                       {(("result", "hit"),): stats["hits"], (("result", "miss"),): stats["misses"]}))
+    return gauges
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/health/backends")
+def backend_health():
+    return jsonify(get_router().snapshot())
 
 
-def call_replicate(language: str, prompt: str):
-    api_token = os.environ.get("REPLICATE_API_TOKEN")
-    debug = os.environ.get("REPLICATE_DEBUG")
-
-    default_version = "meta/llama-2-7b-chat:13c3cdee13ee059ab779f0291d29f1c2684a2ef8fb3fe2cfe2993c3a765db8de"
-    model_version = os.environ.get("REPLICATE_MODEL_VERSION", default_version)
-
-    if not api_token:
-        return 401, "REPLICATE_API_TOKEN not set in environment"
-
-    system = (
-        f"You are an expert {language} programmer. ONLY output valid, runnable {language} source code. "
-        "Do NOT include explanations, markdown, or any extra text. If you cannot comply, output only ERROR_NO_CODE."
-    )
-    user = f"Task: {prompt}\n\nReturn only the code, nothing else."
-    full_prompt = f"{system}\n\n{user}"
-
-    payload = {
-        "version": model_version,
-        "input": {
-            "prompt": full_prompt,
-            "max_tokens": 1600,
-            "temperature": 0.0,
-            "top_p": 1.0,
-        }
-    }
-
-    headers = {
-        "Authorization": f"Token {api_token}",
-        "Content-Type": "application/json",
-    }
-
-    try:
-        r = requests.post(REPLICATE_URL, json=payload, headers=headers, timeout=120)
-    except Exception as e:
-        if debug:
-            print("Replicate request failed:", e)
-        return 502, f"Replicate request failed: {e}"
-
-    if r.status_code not in (200, 201):
-        return r.status_code, r.text
+@app.route("/generate", methods=["POST"])
+def generate():
+    data = request.get_json(silent=True) or {}
+    language = str(data.get("language", "python")).strip().lower()
+    prompt = str(data.get("prompt", "")).strip()
 
-    try:
-        data = r.json()
-        if "output" in data:
-            content = "".join(data["output"]).strip()
-        else:
-            content = str(data).strip()
-    except Exception:
-        return 502, "Failed to parse Replicate response"
-
-    if debug:
-        print("Replicate response:", content[:200])
-
-    # Extract code from fenced blocks
-    if "```" in content:
-        parts = content.split("```")
-        for i in range(1, len(parts), 2):
-            chunk = parts[i]
-            lines = chunk.splitlines()
-            if lines and lines[0].strip().isalpha():
-                code = "\n".join(lines[1:]).strip()
-            else:
-                code = chunk.strip()
-            if code:
-                return 200, code
-
-    # Fallback code extraction based on keywords
-    code_indicators = ("def ", "class ", "if __name__", "import ", "return ")
-    if any(tok in content for tok in code_indicators):
-        lines = content.splitlines()
-        for i, line in enumerate(lines):
-            if any(tok in line for tok in code_indicators):
-                return 200, "\n".join(lines[i:]).strip()
-
-    return 200, content
-
-
-def call_ollama(language: str, prompt: str):
-    debug = os.environ.get("REPLICATE_DEBUG")
-    url = os.environ.get("OLLAMA_URL", "http://127.0.0.1:11434/api/generate")
-    model = os.environ.get("OLLAMA_MODEL", "llama2")
-
-    system = (
-        f"You are an expert {language} programmer. ONLY output valid, runnable {language} source code. "
-        "Do NOT include explanations, markdown, or any extra text. If you cannot comply, output only ERROR_NO_CODE."
-    )
-    user = f"Task: {prompt}\n\nReturn only the code, nothing else."
-
-    payload = {
-        "model": model,
-        "prompt": f"{system}\n\n{user}",
-        "max_tokens": 1600,
-        "temperature": 0.0,
-        "stream": False
-    }
+    key = request_key("generate", language, normalize_prompt(prompt), configured_backends())
+    (status, body), _ = generate_flights.do(key, lambda: generate_code(language, prompt))
+    if status == 200:
+        return Response(body, mimetype="text/plain")
 
-    try:
-        r = requests.post(url, json=payload, timeout=120)
-    except Exception as e:
-        if debug:
-            print("Ollama request failed:", e)
-        return 502, f"Ollama request failed: {e}"
+    # If every backend fails, return clean error
+    return jsonify({"error": body}), status
 
-    if r.status_code != 200:
-        return r.status_code, r.text
 
+@app.route("/generate/best", methods=["POST"])
+def generate_best():
+    """Sample n completions and return the one that scores best against the reference."""
+    data = request.get_json(silent=True) or {}
+    language = str(data.get("language", "python")).strip().lower()
+    prompt = str(data.get("prompt", "")).strip()
+    reference = str(data.get("reference", ""))
+    if not reference.strip():
+        return jsonify({"error": "reference is required to pick the best completion"}), 400
     try:
-        data = r.json()
-        content = data.get("response", "").strip()
-    except Exception:
-        return 502, "Failed to parse Ollama response"
-
-    if debug:
-        print("Ollama response:", content[:200])
-
-    # Extract code in fences
-    if "```" in content:
-        parts = content.split("```")
-        for i in range(1, len(parts), 2):
-            chunk = parts[i]
-            lines = chunk.splitlines()
-            if lines and lines[0].strip().isalpha():
-                code = "\n".join(lines[1:]).strip()
-            else:
-                code = chunk.strip()
-            if code:
-                return 200, code
-
-    # Keyword-based extraction
-    code_indicators = ("def ", "class ", "import ", "return ", ";", "{", "}")
-    if any(tok in content for tok in code_indicators):
-        return 200, content.strip()
-
-    return 200, content
+        n = int(data.get("n", 4))
+        threshold = None if data.get("threshold") is None else float(data["threshold"])
+        seed = int(data.get("seed", 0))
+        if not 1 <= n <= BEST_OF_MAX_N:
+            raise ValueError(f"n must be between 1 and {BEST_OF_MAX_N}")
+        result = generate_best_of(language, prompt, reference, n, threshold, data.get("temperature", DEFAULT_TEMPERATURE), seed)
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+    if result["best"] is None:
+        unavailable = all(s["status"] == 503 for s in result["samples"])
+        return jsonify({"error": "no sample produced code", **result}), 503 if unavailable else 502
+    return jsonify(result)
 
 
-@app.route("/generate", methods=["POST"])
-def generate():
+@app.route("/generate/stream", methods=["POST"])
+def generate_stream():
     data = request.get_json(silent=True) or {}
     language = str(data.get("language", "python")).strip().lower()
     prompt = str(data.get("prompt", "")).strip()
+    def events():
+        for event, payload in stream_generation(language, prompt, use_ollama_enabled()):
+            yield f"event: {event}\ndata: {json.dumps(payload)}\n\n"
 
-    use_ollama = os.environ.get("USE_OLLAMA", "0") in ("1", "true", "True")
-
-    # 1 — Try local Ollama first
-    if use_ollama:
-        status, body = call_ollama(language, prompt)
-        if status == 200:
-            return Response(body, mimetype="text/plain")
-
-    # 2 — Try Replicate next
-    status, body = call_replicate(language, prompt)
-    if status == 200:
-        return Response(body, mimetype="text/plain")
-
-    # 3 — If both fail, return clean error
-    return jsonify({"error": body}), status
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(stream_with_context(events()), mimetype="text/event-stream", headers=headers)
 
 
 @app.route("/")
@@ -179,9 +157,209 @@ def evaluate():
     reference = str(data.get("reference", ""))
     candidate = str(data.get("candidate", ""))
     language = str(data.get("language", "python")).lower().strip()
-    result = compute_codebleu_detailed(reference, candidate, language)
+    key = result_key(reference, candidate, language)
+    result, _ = evaluate_flights.do(key, lambda: score_stored(reference, candidate, language, key))
+    labels = labels_of(data)
+    if labels and get_store() is not None:
+        get_store().record_many([(key, labels)])
     return jsonify(result)
 
 
+@app.route("/evaluate/batch", methods=["POST"])
+def evaluate_batch():
+    data = request.get_json(silent=True)
+    if isinstance(data, dict):
+        pairs = data.get("pairs", [])
+        language = str(data.get("language", "python")).lower().strip()
+    else:
+        pairs, language = data or [], "python"
+    if not isinstance(pairs, list):
+        return jsonify({"error": "pairs must be a list"}), 400
+    # Validate up front: once the 200 is sent, a bad item could only cut the stream short.
+    for i, pair in enumerate(pairs):
+        try:
+            batch_pair(pair, language)
+        except ValueError as e:
+            return jsonify({"error": f"pairs[{i}]: {e}"}), 400
+
+    def lines():
+        for result in score_batch_stored(pairs, language):
+            yield json.dumps(result) + "\n"
+
+    return Response(lines(), mimetype="application/x-ndjson")
+
+
+@app.route("/evaluate/corpus", methods=["POST"])
+def evaluate_corpus():
+    data = request.get_json(silent=True) or {}
+    references = data.get("references", [])
+    candidates = data.get("candidates", [])
+    language = str(data.get("language", "python")).lower().strip()
+    if not isinstance(references, list) or not isinstance(candidates, list) or len(references) != len(candidates):
+        return jsonify({"error": "references and candidates must be lists of equal length"}), 400
+    is_refs = lambda r: isinstance(r, str) or isinstance(r, list) and all(isinstance(x, str) for x in r)
+    if not all(map(is_refs, references)) or not all(isinstance(c, str) for c in candidates):
+        return jsonify({"error": "each reference must be a string or a list of strings, each candidate a string"}), 400
+    return jsonify(compute_codebleu_corpus(references, candidates, language))
+
+
+@app.route("/evaluate/matrix", methods=["POST"])
+def evaluate_matrix():
+    """Score every candidate against every reference; top_k keeps each candidate's best references."""
+    data = request.get_json(silent=True) or {}
+    references = data.get("references", [])
+    candidates = data.get("candidates", [])
+    language = str(data.get("language", "python")).lower().strip()
+    if not isinstance(references, list) or not isinstance(candidates, list):
+        return jsonify({"error": "references and candidates must be lists"}), 400
+    if not all(isinstance(x, str) for x in references + candidates):
+        return jsonify({"error": "references and candidates must be strings"}), 400
+    try:
+        top_k = None if data.get("top_k") is None else max(int(data["top_k"]), 1)
+    except (TypeError, ValueError):
+        return jsonify({"error": "top_k must be an integer"}), 400
+    try:
+        from score_matrix import compute_codebleu_matrix
+    except ImportError as e:
+        return jsonify({"error": f"matrix scoring unavailable: {e}"}), 503
+    return jsonify(compute_codebleu_matrix(references, candidates, language, top_k))
+
+
+@app.route("/evaluate/files", methods=["POST"])
+def evaluate_files():
+    """Score uploaded reference/candidate files without reading them into memory."""
+    uploads = [request.files.get("reference"), request.files.get("candidate")]
+    if not all(uploads):
+        return jsonify({"error": "multipart upload with reference and candidate files required"}), 400
+    language = str(request.form.get("language", "python")).lower().strip()
+    paths = []
+    try:
+        for upload in uploads:
+            fd, path = tempfile.mkstemp(prefix="codebleu-")
+            paths.append(path)
+            with os.fdopen(fd, "wb") as f:
+                upload.save(f)
+        return jsonify(compute_codebleu_files(paths[0], paths[1], language))
+    finally:
+        for path in paths:
+            os.remove(path)
+
+
+@app.route("/search", methods=["POST"])
+def search_references():
+    data = request.get_json(silent=True) or {}
+    candidate = str(data.get("candidate", ""))
+    language = data.get("language")
+    try:
+        k = int(data.get("k", 5))
+        shortlist = int(data.get("shortlist", 100))
+    except (TypeError, ValueError):
+        return jsonify({"error": "k and shortlist must be integers"}), 400
+    try:
+        from ref_index import SEARCH_MAX_SHORTLIST, get_index
+        index = get_index()
+    except (ImportError, OSError, ValueError) as e:
+        return jsonify({"error": f"reference index unavailable: {e}"}), 503
+    if k > SEARCH_MAX_SHORTLIST or shortlist > SEARCH_MAX_SHORTLIST:
+        return jsonify({"error": f"k and shortlist may be at most {SEARCH_MAX_SHORTLIST}"}), 400
+    return jsonify(index.search(candidate, max(k, 1), language and str(language).lower().strip(), shortlist))
+
+
+@app.route("/live", methods=["POST"])
+def create_live_session():
+    data = request.get_json(silent=True) or {}
+    reference = str(data.get("reference", ""))
+    candidate = str(data.get("candidate", ""))
+    language = str(data.get("language", "python")).lower().strip()
+    session = get_sessions().create(reference, candidate, language)
+    return jsonify({"session": session.id, "version": session.version, "scores": session.scores()}), 201
+
+
+@app.route("/live/<session_id>", methods=["POST"])
+def edit_live_session(session_id):
+    session = get_sessions().get(session_id)
+    if session is None:
+        return jsonify({"error": "session not found"}), 404
+    data = request.get_json(silent=True) or {}
+    edits = data.get("edits", [])
+    if not isinstance(edits, list) or not all(isinstance(e, dict) for e in edits):
+        return jsonify({"error": "edits must be a list of {start, end, text} objects"}), 400
+    try:
+        scores = session.edit(data.get("version"), edits)
+    except VersionConflict as e:
+        return jsonify({"error": str(e), "version": e.version}), 409
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"session": session.id, "version": session.version, "scores": scores})
+
+
+@app.route("/live/<session_id>", methods=["DELETE"])
+def close_live_session(session_id):
+    get_sessions().drop(session_id)
+    return "", 204
+
+
+@app.route("/results/history")
+def result_history():
+    store = get_store()
+    if store is None:
+        return jsonify({"error": "result store disabled"}), 503
+    prompt = request.args.get("prompt")
+    if not prompt:
+        return jsonify({"error": "prompt is required"}), 400
+    limit = request.args.get("limit", 100, type=int)
+    return jsonify({"prompt": prompt, "history": store.history(prompt, request.args.get("model"), limit)})
+
+
+@app.route("/results/regressions")
+def result_regressions():
+    store = get_store()
+    if store is None:
+        return jsonify({"error": "result store disabled"}), 503
+    base, new = request.args.get("base"), request.args.get("new")
+    if not base or not new:
+        return jsonify({"error": "base and new are required"}), 400
+    try:
+        regressions = store.regressions(base, new, request.args.get("by", "model"),
+                                        request.args.get("min_drop", 0.0, type=float),
+                                        request.args.get("limit", 100, type=int))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"base": base, "new": new, "regressions": regressions})
+
+
+@app.route("/jobs", methods=["POST"])
+def create_job():
+    data = request.get_json(silent=True) or {}
+    items = data.get("items", [])
+    language = str(data.get("language", "python")).lower().strip()
+    if not isinstance(items, list) or not items or not all(isinstance(item, dict) for item in items):
+        return jsonify({"error": "items must be a non-empty list of objects"}), 400
+    runner = get_runner()
+    job_id = runner.submit(items, language)
+    return jsonify(runner.store.status(job_id)), 202
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    status = get_runner().store.status(job_id)
+    if status is None:
+        return jsonify({"error": "job not found"}), 404
+    return jsonify(status)
+
+
+@app.route("/jobs/<job_id>/results", methods=["GET"])
+def job_results(job_id):
+    store = get_runner().store
+    status = store.status(job_id)
+    if status is None:
+        return jsonify({"error": "job not found"}), 404
+    return jsonify({**status, "results": store.results(job_id)})
+
+
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8000, debug=True)
+    debug = True
+    # Under the reloader this file runs twice; only the serving child resumes jobs.
+    if JOBS_AUTOSTART and (not debug or os.environ.get("WERKZEUG_RUN_MAIN") == "true"):
+        get_runner()
+    app.run(host="0.0.0.0", port=8000, debug=debug)
@@ -0,0 +1,142 @@
+"""Low-overhead counters and histograms rendered in the Prometheus text format.
+
+Stages are timed with the `timed` context manager, which records into a
+histogram and, when the current thread has an active trace (see start_trace),
+into a per-request timing breakdown as well.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+_registry = []
+_collectors = []
+_local = threading.local()
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames=()):
+        self.name, self.help, self.labelnames = name, help, tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount: float=1.0, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {value}"
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name, self.help, self.labelnames = name, help, tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            items = sorted((key, (list(s[0]), s[1], s[2])) for key, s in self._series.items())
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', le)])} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, key)} {count}"
+
+
+def register_collector(fn):
+    """fn() returns [(name, help, {labels tuple: value})] gauges, read at scrape time."""
+    _collectors.append(fn)
+    return fn
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    for collect in _collectors:
+        for name, help, samples in collect():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in samples.items():
+                lines.append(f"{name}{_format_labels([k for k, _ in labels], [v for _, v in labels])} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def start_trace():
+    _local.trace = {}
+
+
+def end_trace() -> dict:
+    trace = getattr(_local, "trace", None)
+    _local.trace = None
+    return trace
+
+
+def record(histogram: Histogram, elapsed: float, trace_name: str=None, **labels):
+    """Observe elapsed seconds, and add them to the current thread's trace if one is active."""
+    histogram.observe(elapsed, **labels)
+    trace = getattr(_local, "trace", None)
+    if trace is not None:
+        name = trace_name or "/".join(str(v) for v in labels.values()) or histogram.name
+        trace[name] = trace.get(name, 0.0) + elapsed
+
+
+@contextmanager
+def timed(histogram: Histogram, trace_name: str=None, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(histogram, time.perf_counter() - start, trace_name, **labels)
+
+
+HTTP_SECONDS = Histogram("http_request_seconds", "Flask request latency (time to first byte for streams).",
+                         ("route", "method", "status"))
+UPSTREAM_SECONDS = Histogram("llm_upstream_seconds", "LLM backend call latency.", ("backend", "status"))
+EXTRACT_SECONDS = Histogram("llm_extract_seconds", "Code extraction from LLM output.", ("backend",))
+FALLBACKS = Counter("llm_fallbacks_total", "Generations that fell through from one backend to the next.",
+                    ("from_backend", "to_backend"))
+CIRCUIT_TRANSITIONS = Counter("llm_circuit_transitions_total", "LLM backend circuit breaker state changes.",
+                              ("backend", "state"))
+EARLY_STOPS = Counter("llm_early_stops_total", "Generations cut off once the first code block was complete.",
+                      ("backend",))
+EVAL_STAGE_SECONDS = Histogram("evaluator_stage_seconds", "Time per CodeBLEU evaluator stage.", ("stage",))
+COALESCED = Counter("coalesced_requests_total", "Requests that joined an identical in-flight call.", ("route",))
+ADMISSION_REJECTS = Counter("admission_rejects_total", "Requests refused with 429 because too many were in flight.",
+                            ("route",))
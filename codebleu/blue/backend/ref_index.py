@@ -0,0 +1,230 @@
+"""Nearest-reference search: MinHash/LSH shortlisting, exact CodeBLEU re-ranking.
+
+    python -m ref_index build references.jsonl -o ref_index --language python
+    python -m ref_index search ref_index candidate.py -k 5
+
+Each reference is reduced to the set of its token n-gram shingles (from
+tokenize_code) and a MinHash signature of num_perm values. Signatures are cut
+into bands; references sharing any band hash with the query are shortlisted,
+the shortlist is narrowed by estimated Jaccard similarity, and only those
+references are scored with compute_codebleu_detailed.
+
+The index is a directory of .npy arrays opened with mmap_mode="r", plus the
+references as JSONL with a byte-offset table, so opening it reads nothing up
+front and a search touches only the pages it needs:
+
+    meta.json        parameters and reference count
+    signatures.npy   (N, num_perm) uint32 MinHash signatures
+    band_keys.npy    (bands, N) uint64 band hashes, each row sorted
+    band_docs.npy    (bands, N) uint32 reference numbers in band_keys order
+    records.jsonl    {"id", "reference", "language"} per reference
+    offsets.npy      (N + 1) uint64 byte offsets of records.jsonl lines
+"""
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import sys
+
+import numpy as np
+
+from evaluator import compute_codebleu_detailed, tokenize_code
+
+REF_INDEX_PATH = os.environ.get("REF_INDEX_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "ref_index"))
+FORMAT_VERSION = 1
+# Most references one /search request may score exactly (k and shortlist are capped to this).
+SEARCH_MAX_SHORTLIST = int(os.environ.get("SEARCH_MAX_SHORTLIST", "1000"))
+DEFAULT_NUM_PERM, DEFAULT_BANDS, DEFAULT_SHINGLE = 128, 32, 3
+_SHINGLE_MULT = np.uint64(0x9E3779B97F4A7C15)
+
+
+class MinHasher:
+    """Token-shingle MinHash with seeded multiply-shift permutations; deterministic across runs."""
+
+    def __init__(self, num_perm: int=DEFAULT_NUM_PERM, bands: int=DEFAULT_BANDS, shingle: int=DEFAULT_SHINGLE,
+                 seed: int=1):
+        if num_perm % bands:
+            raise ValueError(f"num_perm ({num_perm}) must be a multiple of bands ({bands})")
+        self.num_perm, self.bands, self.shingle, self.seed = num_perm, bands, shingle, seed
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(0, 2**64, num_perm, dtype=np.uint64) | np.uint64(1)
+        self._b = rng.integers(0, 2**64, num_perm, dtype=np.uint64)
+        self._band_mult = rng.integers(0, 2**64, num_perm // bands, dtype=np.uint64) | np.uint64(1)
+        self._token_hashes = {}
+
+    def _token_hash(self, tok: str) -> int:
+        h = self._token_hashes.get(tok)
+        if h is None:
+            h = self._token_hashes[tok] = int.from_bytes(hashlib.blake2b(tok.encode("utf-8", "surrogatepass"),
+                                                                         digest_size=8).digest(), "little")
+        return h
+
+    def shingles(self, text: str) -> np.ndarray:
+        """Distinct 64-bit hashes of the text's token n-grams (the whole text if shorter)."""
+        tokens = np.array([self._token_hash(tok) for tok in tokenize_code(text)], dtype=np.uint64)
+        k = min(self.shingle, len(tokens))
+        if k == 0:
+            return tokens
+        keys = tokens[:len(tokens) - k + 1].copy()
+        for i in range(1, k):
+            keys = keys * _SHINGLE_MULT + tokens[i:len(tokens) - k + 1 + i]
+        return np.unique(keys)
+
+    def signature(self, text: str) -> np.ndarray:
+        shingles = self.shingles(text)
+        if len(shingles) == 0:
+            return np.full(self.num_perm, np.iinfo(np.uint32).max, dtype=np.uint32)
+        hashed = (self._a[:, None] * shingles[None, :] + self._b[:, None]) >> np.uint64(32)
+        return hashed.min(axis=1).astype(np.uint32)
+
+    def band_keys(self, signatures: np.ndarray) -> np.ndarray:
+        """(..., num_perm) signatures -> (..., bands) band hashes."""
+        rows = signatures.reshape(signatures.shape[:-1] + (self.bands, self.num_perm // self.bands)).astype(np.uint64)
+        return (rows * self._band_mult).sum(axis=-1, dtype=np.uint64)
+
+    def params(self) -> dict:
+        return {"num_perm": self.num_perm, "bands": self.bands, "shingle": self.shingle, "seed": self.seed}
+
+
+def build_index(records, path: str, language: str="python", **params) -> int:
+    """Write an index of records ({"reference", optional "id"/"language"}) to path; return the count."""
+    hasher = MinHasher(**params)
+    os.makedirs(path, exist_ok=True)
+    signatures, offsets = [], [0]
+    with open(os.path.join(path, "records.jsonl"), "wb") as out:
+        for n, record in enumerate(records):
+            reference = str(record.get("reference", record.get("code", "")))
+            line = json.dumps({
+                "id": record.get("id", n),
+                "reference": reference,
+                "language": str(record.get("language", language)).lower().strip(),
+            }).encode("utf-8") + b"\n"
+            out.write(line)
+            offsets.append(offsets[-1] + len(line))
+            signatures.append(hasher.signature(reference))
+    signatures = np.array(signatures, dtype=np.uint32).reshape(-1, hasher.num_perm)
+    keys = hasher.band_keys(signatures).T
+    order = np.argsort(keys, axis=1, kind="stable")
+    np.save(os.path.join(path, "signatures.npy"), signatures)
+    np.save(os.path.join(path, "band_keys.npy"), np.take_along_axis(keys, order, axis=1))
+    np.save(os.path.join(path, "band_docs.npy"), order.astype(np.uint32))
+    np.save(os.path.join(path, "offsets.npy"), np.array(offsets, dtype=np.uint64))
+    with open(os.path.join(path, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({"format": FORMAT_VERSION, "count": len(signatures), "language": language, **hasher.params()}, f)
+    return len(signatures)
+
+
+class RefIndex:
+    def __init__(self, path: str=REF_INDEX_PATH):
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+            self.meta = json.load(f)
+        if self.meta.get("format") != FORMAT_VERSION:
+            raise ValueError(f"unsupported index format {self.meta.get('format')!r} in {path}")
+        self.path, self.language = path, self.meta["language"]
+        self.hasher = MinHasher(self.meta["num_perm"], self.meta["bands"], self.meta["shingle"], self.meta["seed"])
+        load = lambda name: np.load(os.path.join(path, name), mmap_mode="r")
+        self.signatures, self.offsets = load("signatures.npy"), load("offsets.npy")
+        self.band_keys, self.band_docs = load("band_keys.npy"), load("band_docs.npy")
+        self._file = open(os.path.join(path, "records.jsonl"), "rb")
+        self._records = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self.offsets[-1] else b""
+
+    def __len__(self):
+        return int(self.meta["count"])
+
+    def record(self, n: int) -> dict:
+        return json.loads(self._records[int(self.offsets[n]):int(self.offsets[n + 1])])
+
+    def shortlist(self, candidate: str, size: int=100, min_results: int=1):
+        """Reference numbers and estimated Jaccard similarities, best first.
+
+        References colliding with the candidate in any LSH band are ranked by
+        signature agreement. If that yields fewer than min_results, every
+        signature is compared instead.
+        """
+        sig = self.hasher.signature(candidate)
+        keys = self.hasher.band_keys(sig)
+        hits = []
+        for band, key in enumerate(keys):
+            row = self.band_keys[band]
+            lo, hi = np.searchsorted(row, key, "left"), np.searchsorted(row, key, "right")
+            hits.append(self.band_docs[band][lo:hi])
+        docs = np.unique(np.concatenate(hits)) if hits else np.empty(0, np.uint32)
+        if len(docs) < min_results:
+            docs = np.arange(len(self), dtype=np.uint32)
+        similarity = np.empty(len(docs))
+        for start in range(0, len(docs), 65536):
+            block = docs[start:start + 65536]
+            similarity[start:start + len(block)] = (self.signatures[block] == sig).mean(axis=1)
+        best = np.argsort(-similarity, kind="stable")[:size]
+        return docs[best], similarity[best]
+
+    def search(self, candidate: str, k: int=5, language: str=None, shortlist: int=100) -> dict:
+        """Top-k references by CodeBLEU FinalScore among the MinHash shortlist."""
+        docs, similarity = self.shortlist(candidate, max(shortlist, k), k)
+        results = []
+        for n, sim in zip(docs, similarity):
+            record = self.record(n)
+            scores = compute_codebleu_detailed(record["reference"], candidate, language or record["language"])
+            results.append({"id": record["id"], "similarity": round(float(sim), 4), "scores": scores})
+        results.sort(key=lambda r: -r["scores"]["FinalScore"])
+        return {"results": results[:k], "shortlisted": len(results), "indexed": len(self)}
+
+    def close(self):
+        if isinstance(self._records, mmap.mmap):
+            self._records.close()
+        self._file.close()
+
+
+_index = None
+
+
+def get_index() -> RefIndex:
+    """Process-wide index at REF_INDEX_PATH, opened on first use."""
+    global _index
+    if _index is None:
+        _index = RefIndex(REF_INDEX_PATH)
+    return _index
+
+
+def _read_jsonl(path: str):
+    src = sys.stdin if path == "-" else open(path, encoding="utf-8")
+    try:
+        for line in src:
+            if line.strip():
+                yield json.loads(line)
+    finally:
+        if src is not sys.stdin:
+            src.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m ref_index", description="MinHash/LSH index of reference solutions.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="index a JSONL file of {\"id\", \"reference\", \"language\"} records")
+    build.add_argument("input", help="JSONL file of references, or - for stdin")
+    build.add_argument("-o", "--output", default=REF_INDEX_PATH, help="index directory")
+    build.add_argument("--language", default="python", help="default language for records without one")
+    build.add_argument("--num-perm", type=int, default=DEFAULT_NUM_PERM, help="MinHash signature length")
+    build.add_argument("--bands", type=int, default=DEFAULT_BANDS, help="LSH bands (must divide --num-perm)")
+    build.add_argument("--shingle", type=int, default=DEFAULT_SHINGLE, help="tokens per shingle")
+    build.add_argument("--seed", type=int, default=1)
+    search = commands.add_parser("search", help="find the references closest to a candidate file")
+    search.add_argument("index", help="index directory")
+    search.add_argument("candidate", help="candidate source file, or - for stdin")
+    search.add_argument("-k", type=int, default=5)
+    search.add_argument("--shortlist", type=int, default=100, help="references re-ranked with the exact metric")
+    search.add_argument("--language", help="score as this language instead of each reference's")
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        count = build_index(_read_jsonl(args.input), args.output, args.language.lower().strip(),
+                            num_perm=args.num_perm, bands=args.bands, shingle=args.shingle, seed=args.seed)
+        print(f"indexed {count} references into {args.output}", file=sys.stderr)
+    else:
+        candidate = sys.stdin.read() if args.candidate == "-" else open(args.candidate, encoding="utf-8").read()
+        print(json.dumps(RefIndex(args.index).search(candidate, args.k, args.language, args.shortlist), indent=2))
+
+
+if __name__ == "__main__":
+    main()
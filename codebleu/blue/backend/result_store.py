@@ -0,0 +1,238 @@
+"""Content-addressed store of evaluation results, with score history and regression queries.
+
+    python -m result_store history "reverse a string" --model llama2
+    python -m result_store regressions llama2 codellama --min-drop 0.05
+
+Scores are a pure function of (reference, candidate, language) for a given
+scorer, so each result is stored once under a hash of those and
+SCORER_VERSION (plus the CODEBLEU_SYNTAX mode). /evaluate, /evaluate/batch,
+/jobs and the cli consult the store before scoring and save what they
+compute, so an unchanged pair is never scored twice.
+
+Callers may label an evaluation with the prompt, model and run it came from.
+Labels are kept separately from the results, one row per evaluation, which
+is what history() and regressions() query.
+"""
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from itertools import islice
+
+import evaluator
+from evaluator import SCORER_VERSION, batch_pair, compute_codebleu_detailed
+
+RESULT_STORE_PATH = os.environ.get("RESULT_STORE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "results.sqlite3"))
+LABELS = ("prompt", "model", "run")
+# Keys per SELECT ... IN (...); stays under SQLite's bound-parameter limit.
+_LOOKUP_CHUNK = 500
+_BATCH_CHUNK = 256
+
+
+def scorer_id() -> str:
+    return f"{SCORER_VERSION}/{evaluator.SYNTAX_COMPONENT}"
+
+
+def result_key(reference, candidate: str, language: str="python") -> str:
+    """Content hash of one evaluation; reference may be a string or a list of references."""
+    material = json.dumps([scorer_id(), language.strip().lower(), reference, candidate])
+    return hashlib.sha256(material.encode("utf-8", "surrogatepass")).hexdigest()
+
+
+def labels_of(data: dict) -> dict:
+    """The prompt/model/run labels present in a request or record."""
+    return {name: str(data[name]) for name in LABELS if data.get(name) is not None}
+
+
+class ResultStore:
+    def __init__(self, path: str=RESULT_STORE_PATH):
+        self.path = path
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " key TEXT PRIMARY KEY, scorer TEXT NOT NULL, language TEXT NOT NULL, final REAL NOT NULL,"
+            " scores TEXT NOT NULL, created REAL NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS evaluations ("
+            " id INTEGER PRIMARY KEY, key TEXT NOT NULL, prompt TEXT, model TEXT, run TEXT, created REAL NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS evaluations_prompt ON evaluations(prompt, created);"
+            "CREATE INDEX IF NOT EXISTS evaluations_model ON evaluations(model, prompt, created);"
+            "CREATE INDEX IF NOT EXISTS evaluations_run ON evaluations(run, prompt, created);"
+        )
+
+    def get(self, key: str):
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys) -> dict:
+        """Stored scores for whichever of keys are present."""
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), _LOOKUP_CHUNK):
+                chunk = keys[start:start + _LOOKUP_CHUNK]
+                rows = self._conn.execute(
+                    f"SELECT key, scores FROM results WHERE key IN ({','.join('?' * len(chunk))})", chunk).fetchall()
+                found.update((key, json.loads(scores)) for key, scores in rows)
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put(self, key: str, language: str, scores: dict):
+        self.put_many([(key, language, scores)])
+
+    def put_many(self, rows):
+        """Store (key, language, scores) rows in one transaction; existing keys are left alone."""
+        now, scorer = time.time(), scorer_id()
+        values = [(key, scorer, language, scores["FinalScore"], json.dumps(scores), now) for key, language, scores in rows]
+        if not values:
+            return
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany("INSERT OR IGNORE INTO results VALUES (?, ?, ?, ?, ?, ?)", values)
+            self._conn.execute("COMMIT")
+
+    def record_many(self, rows):
+        """Log labelled evaluations: (key, {"prompt", "model", "run"}) rows; unlabelled ones are skipped."""
+        now = time.time()
+        values = [(key, labels.get("prompt"), labels.get("model"), labels.get("run"), now)
+                  for key, labels in rows if labels]
+        if not values:
+            return
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany("INSERT INTO evaluations (key, prompt, model, run, created) VALUES (?, ?, ?, ?, ?)",
+                                   values)
+            self._conn.execute("COMMIT")
+
+    def history(self, prompt: str, model: str=None, limit: int=100) -> list:
+        """A prompt's labelled evaluations, newest first."""
+        query = ("SELECT e.created, e.model, e.run, r.scores FROM evaluations e JOIN results r ON r.key = e.key"
+                 " WHERE e.prompt = ?")
+        params = [prompt]
+        if model is not None:
+            query += " AND e.model = ?"
+            params.append(model)
+        with self._lock:
+            rows = self._conn.execute(query + " ORDER BY e.created DESC LIMIT ?", params + [limit]).fetchall()
+        return [{"created": created, "model": model, "run": run, "scores": json.loads(scores)}
+                for created, model, run, scores in rows]
+
+    def regressions(self, base: str, new: str, by: str="model", min_drop: float=0.0, limit: int=100) -> list:
+        """Prompts whose latest FinalScore under new is more than min_drop below that under base.
+
+        by chooses the label compared, "model" or "run". Worst drops come first.
+        """
+        if by not in ("model", "run"):
+            raise ValueError("by must be 'model' or 'run'")
+        # SQLite takes the bare columns of a MAX() aggregate from the row holding the maximum.
+        latest = (f"SELECT e.prompt AS prompt, r.final AS final, MAX(e.created) AS created"
+                  f" FROM evaluations e JOIN results r ON r.key = e.key"
+                  f" WHERE e.{by} = ? AND e.prompt IS NOT NULL GROUP BY e.prompt")
+        query = (f"SELECT b.prompt, b.final, n.final FROM ({latest}) b JOIN ({latest}) n ON n.prompt = b.prompt"
+                 f" WHERE n.final < b.final - ? ORDER BY n.final - b.final, b.prompt LIMIT ?")
+        with self._lock:
+            rows = self._conn.execute(query, (base, new, min_drop, limit)).fetchall()
+        return [{"prompt": prompt, "base": base_final, "new": new_final, "delta": round(new_final - base_final, 4)}
+                for prompt, base_final, new_final in rows]
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {"entries": entries, "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """Process-wide store, or None when RESULT_STORE=0."""
+    global _store
+    if os.environ.get("RESULT_STORE", "1") in ("0", "false", "False"):
+        return None
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = ResultStore()
+    return _store
+
+
+def score_stored(reference: str, candidate: str, language: str="python", key: str=None) -> dict:
+    """compute_codebleu_detailed, answered from the store when the pair has been scored before."""
+    store = get_store()
+    if store is None:
+        return compute_codebleu_detailed(reference, candidate, language)
+    key = key or result_key(reference, candidate, language)
+    scores = store.get(key)
+    if scores is None:
+        scores = compute_codebleu_detailed(reference, candidate, language)
+        store.put(key, language, scores)
+    return scores
+
+
+def score_batch_stored(pairs, language: str="python"):
+    """compute_codebleu_batch through the store: one lookup and one insert per chunk of pairs.
+
+    Dict items may carry prompt/model/run labels, which are recorded.
+    """
+    store = get_store()
+    if store is None:
+        yield from evaluator.compute_codebleu_batch(pairs, language)
+        return
+    pairs = iter(pairs)
+    while True:
+        chunk = list(islice(pairs, _BATCH_CHUNK))
+        if not chunk:
+            return
+        items = [batch_pair(pair, language) for pair in chunk]
+        keys = [result_key(*item) for item in items]
+        found = store.get_many(keys)
+        fresh = {}
+        for key, (reference, candidate, lang) in zip(keys, items):
+            if key not in found and key not in fresh:
+                fresh[key] = (lang, compute_codebleu_detailed(reference, candidate, lang))
+        store.put_many((key, lang, scores) for key, (lang, scores) in fresh.items())
+        store.record_many((key, labels_of(pair)) for key, pair in zip(keys, chunk) if isinstance(pair, dict))
+        for key in keys:
+            yield found[key] if key in found else fresh[key][1]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m result_store", description="Query stored CodeBLEU results.")
+    parser.add_argument("--path", default=RESULT_STORE_PATH, help="store file")
+    commands = parser.add_subparsers(dest="command", required=True)
+    history = commands.add_parser("history", help="a prompt's labelled evaluations, newest first")
+    history.add_argument("prompt")
+    history.add_argument("--model")
+    history.add_argument("--limit", type=int, default=100)
+    regressions = commands.add_parser("regressions", help="prompts that score lower under new than under base")
+    regressions.add_argument("base")
+    regressions.add_argument("new")
+    regressions.add_argument("--by", choices=("model", "run"), default="model", help="label to compare")
+    regressions.add_argument("--min-drop", type=float, default=0.0, help="ignore drops in FinalScore up to this")
+    regressions.add_argument("--limit", type=int, default=100)
+    commands.add_parser("stats", help="number of stored results")
+    args = parser.parse_args(argv)
+
+    store = ResultStore(args.path)
+    if args.command == "history":
+        result = store.history(args.prompt, args.model, args.limit)
+    elif args.command == "regressions":
+        result = store.regressions(args.base, args.new, args.by, args.min_drop, args.limit)
+    else:
+        result = {"entries": store.stats()["entries"], "scorer": scorer_id()}
+    json.dump(result, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
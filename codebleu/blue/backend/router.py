@@ -0,0 +1,190 @@
+"""Health-aware ordering of LLM backends, with per-backend circuit breakers.
+
+Every upstream call reports its outcome and latency. After
+LLM_BREAKER_FAILURES consecutive failures a backend's circuit opens and it is
+skipped outright, so a dead Ollama costs nothing instead of a connect timeout
+per request. After LLM_BREAKER_COOLDOWN seconds (or as soon as the background
+probe sees it answering again) the circuit is half-open: one request is let
+through, and its outcome closes or re-opens the circuit.
+
+Backends are ordered by circuit state, then by whether their recent latency
+is above LLM_SLOW_SECONDS, then by recent failure rate, and otherwise keep
+their configured order.
+"""
+import os
+import threading
+import time
+from collections import deque
+
+from metrics import CIRCUIT_TRANSITIONS
+
+LLM_BREAKER_FAILURES = int(os.environ.get("LLM_BREAKER_FAILURES", "3"))
+LLM_BREAKER_COOLDOWN = float(os.environ.get("LLM_BREAKER_COOLDOWN", "30"))
+LLM_PROBE_INTERVAL = float(os.environ.get("LLM_PROBE_INTERVAL", "15"))
+LLM_HEALTH_WINDOW = int(os.environ.get("LLM_HEALTH_WINDOW", "50"))
+LLM_SLOW_SECONDS = float(os.environ.get("LLM_SLOW_SECONDS", "30"))
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+_STATE_RANK = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+# Statuses that say something about the backend rather than the request.
+_FAILURE_STATUSES = (401, 403, 408, 429)
+_EWMA_ALPHA = 0.2
+
+
+def is_failure(status: int) -> bool:
+    return status >= 500 or status in _FAILURE_STATUSES
+
+
+class BackendHealth:
+    def __init__(self, name: str, window: int=LLM_HEALTH_WINDOW):
+        self.name = name
+        self.outcomes = deque(maxlen=window)  # (ok, seconds)
+        self.latency = None                   # EWMA of successful call latency, seconds
+        self.consecutive_failures = 0
+        self.state, self.opened_at, self.trial_started = CLOSED, 0.0, None
+        self.last_error, self.last_seen, self.last_probe = None, None, None
+
+    @property
+    def failure_rate(self) -> float:
+        return sum(not ok for ok, _ in self.outcomes) / len(self.outcomes) if self.outcomes else 0.0
+
+    def snapshot(self) -> dict:
+        latencies = sorted(s for ok, s in self.outcomes if ok)
+        return {
+            "state": self.state,
+            "calls": len(self.outcomes),
+            "failure_rate": round(self.failure_rate, 4),
+            "consecutive_failures": self.consecutive_failures,
+            "latency_ewma_s": None if self.latency is None else round(self.latency, 4),
+            "latency_p50_s": round(latencies[len(latencies) // 2], 4) if latencies else None,
+            "last_error": self.last_error,
+            "last_probe": self.last_probe,
+        }
+
+
+class BackendRouter:
+    def __init__(self, probes=None, failures: int=LLM_BREAKER_FAILURES, cooldown: float=LLM_BREAKER_COOLDOWN,
+                 slow: float=LLM_SLOW_SECONDS):
+        """probes maps backend name -> fn() returning True (up), False (down) or None (not in use)."""
+        self.probes = dict(probes or {})
+        self.failures, self.cooldown, self.slow = failures, cooldown, slow
+        self._health = {}
+        self._lock = threading.Lock()
+        self._probe_thread = None
+
+    def _get(self, name: str) -> BackendHealth:
+        health = self._health.get(name)
+        if health is None:
+            health = self._health[name] = BackendHealth(name)
+        return health
+
+    def _set_state(self, health: BackendHealth, state: str, now: float):
+        if health.state != state:
+            health.state = state
+            health.trial_started = None
+            if state == OPEN:
+                health.opened_at = now
+            CIRCUIT_TRANSITIONS.inc(backend=health.name, state=state)
+
+    def order(self, names) -> list:
+        """names that may be called now, healthiest first; open circuits are left out."""
+        now = time.monotonic()
+        ranked = []
+        with self._lock:
+            for index, name in enumerate(names):
+                health = self._get(name)
+                if health.state == OPEN and now - health.opened_at >= self.cooldown:
+                    self._set_state(health, HALF_OPEN, now)
+                if health.state == OPEN:
+                    continue
+                slow = health.latency is not None and health.latency > self.slow
+                ranked.append(((_STATE_RANK[health.state], slow, round(health.failure_rate, 1), index), name))
+        return [name for _, name in sorted(ranked)]
+
+    def admit(self, name: str) -> bool:
+        """Claim a call to name; a half-open backend admits one trial call at a time.
+
+        A trial that never reports back (e.g. its caller went away) is given up
+        on after the cooldown, and another one is admitted.
+        """
+        now = time.monotonic()
+        with self._lock:
+            health = self._get(name)
+            if health.state == CLOSED:
+                return True
+            if health.state == HALF_OPEN and (health.trial_started is None or now - health.trial_started >= self.cooldown):
+                health.trial_started = now
+                return True
+            return False
+
+    def record(self, name: str, status: int, seconds: float, error: str=None):
+        """Report the outcome of a call; statuses that are the request's fault are ignored."""
+        ok, failed = status == 200, is_failure(status)
+        if not ok and not failed:
+            with self._lock:
+                self._get(name).trial_started = None
+            return
+        now = time.monotonic()
+        with self._lock:
+            health = self._get(name)
+            health.outcomes.append((ok, seconds))
+            health.last_seen = now
+            if ok:
+                health.consecutive_failures = 0
+                health.latency = seconds if health.latency is None else (
+                    _EWMA_ALPHA * seconds + (1 - _EWMA_ALPHA) * health.latency)
+                self._set_state(health, CLOSED, now)
+            else:
+                health.consecutive_failures += 1
+                health.last_error = f"{status} {error or ''}".strip()[:200]
+                if health.state == HALF_OPEN or health.consecutive_failures >= self.failures:
+                    self._set_state(health, OPEN, now)
+
+    def unavailable_message(self, names) -> str:
+        with self._lock:
+            reasons = [f"{name}: circuit {self._get(name).state}"
+                       + (f" (last error: {self._get(name).last_error})" if self._get(name).last_error else "")
+                       for name in names]
+        return "All LLM backends are unavailable; retry shortly. " + "; ".join(reasons)
+
+    def probe(self, interval: float=LLM_PROBE_INTERVAL):
+        """Run each probe once; backends that saw real traffic within the last interval are skipped."""
+        for name, probe in self.probes.items():
+            with self._lock:
+                last_seen = self._get(name).last_seen
+            if last_seen is not None and time.monotonic() - last_seen < interval:
+                continue
+            try:
+                up = probe()
+            except Exception:
+                up = False
+            if up is None:
+                continue
+            now = time.monotonic()
+            with self._lock:
+                health = self._get(name)
+                health.last_probe = "up" if up else "down"
+                if up and health.state == OPEN:
+                    self._set_state(health, HALF_OPEN, now)
+                elif not up:
+                    health.consecutive_failures += 1
+                    health.last_error = "health probe failed"
+                    if health.state == HALF_OPEN or health.consecutive_failures >= self.failures:
+                        self._set_state(health, OPEN, now)
+
+    def start_probes(self, interval: float=LLM_PROBE_INTERVAL):
+        """Probe every backend in a daemon thread every interval seconds (0 disables)."""
+        with self._lock:
+            if interval <= 0 or self._probe_thread is not None:
+                return
+            self._probe_thread = threading.Thread(target=self._probe_loop, args=(interval,), name="llm-probe", daemon=True)
+        self._probe_thread.start()
+
+    def _probe_loop(self, interval: float):
+        while True:
+            self.probe(interval)
+            time.sleep(interval)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {name: health.snapshot() for name, health in self._health.items()}
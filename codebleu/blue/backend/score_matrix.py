@@ -0,0 +1,276 @@
+"""All-pairs CodeBLEU: score N candidates against M references in one pass.
+
+    python -m score_matrix pairs.json --top-k 5
+
+Every text is profiled once. Candidate features (n-grams per order,
+operators, braces, identifiers, syntax subtrees) define a shared column
+vocabulary; each reference keeps only the features some candidate has, since
+nothing else can match. The clipped count sum_v min(c[i, v], r[j, v]) for all
+pairs is then a handful of matrix products: min(a, b) is the number of levels
+t >= 1 with a >= t and b >= t, so levels 1..MATRIX_LEVELS are 0/1 products and
+the few columns with larger counts on both sides are done one by one.
+
+References are processed in blocks of MATRIX_REF_BLOCK, so memory is bounded
+by N x block rather than N x M when only the top-k per candidate is kept.
+Scores are identical to compute_codebleu_detailed for every pair.
+"""
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+import evaluator
+from evaluator import LANG_KEYWORDS, MAX_ORDER, SYNTAX_BRACES, SYNTAX_OPS, get_profile
+
+MATRIX_REF_BLOCK = int(os.environ.get("MATRIX_REF_BLOCK", "256"))
+# Levels handled by 0/1 products; columns where both sides exceed this are summed directly.
+MATRIX_LEVELS = 8
+# Dense cells per operand materialised at a time.
+_BLOCK_CELLS = 1 << 22
+FAMILIES = tuple(f"ngram{n}" for n in range(1, MAX_ORDER + 1)) + ("ops", "braces", "identifiers", "subtrees")
+COMPONENTS = ("BLEU-4", "KeywordPrecision", "SyntaxOverlap", "IdentifierPenalty", "SyntaxMatch", "FinalScore")
+
+
+def _min_sum(C: np.ndarray, R: np.ndarray) -> np.ndarray:
+    """out[i, j] = sum_v min(C[i, v], R[j, v]) for non-negative integer counts."""
+    out = np.zeros((C.shape[0], R.shape[0]))
+    if not out.size or not C.shape[1]:
+        return out
+    heavy = (C.max(axis=0) > MATRIX_LEVELS) & (R.max(axis=0) > MATRIX_LEVELS)
+    Cl, Rl = C[:, ~heavy], R[:, ~heavy]
+    for t in range(1, MATRIX_LEVELS + 1):
+        a, b = Cl >= t, Rl >= t
+        cols = a.any(axis=0) & b.any(axis=0)
+        if not cols.any():
+            break
+        out += a[:, cols].astype(np.float64) @ b[:, cols].T.astype(np.float64)
+    for v in np.flatnonzero(heavy):
+        out += np.minimum(C[:, v][:, None], R[:, v][None, :])
+    return out
+
+
+class _Features:
+    """Candidate-side counts of one feature family as COO arrays, plus its column vocabulary."""
+
+    def __init__(self, counters, vocab=None):
+        self.vocab = {} if vocab is None else vocab
+        rows, cols, counts = [], [], []
+        for i, counter in enumerate(counters):
+            for key, c in counter.items():
+                col = self.vocab.setdefault(key, len(self.vocab))
+                rows.append(i)
+                cols.append(col)
+                counts.append(c)
+        self.n = len(counters)
+        self.rows, self.cols = np.array(rows, np.int64), np.array(cols, np.int64)
+        self.counts = np.array(counts, np.float64)
+        self.totals = np.bincount(self.rows, self.counts, minlength=self.n)
+
+    def encode(self, counter):
+        """A reference's (columns, counts) restricted to this vocabulary, and its total count."""
+        cols, counts = [], []
+        for key, c in counter.items():
+            col = self.vocab.get(key)
+            if col is not None:
+                cols.append(col)
+                counts.append(c)
+        return cols, counts, sum(counter.values())
+
+    def min_sum(self, ref_rows, ref_cols, ref_counts, n_refs: int) -> np.ndarray:
+        """(N, n_refs) matrix of sum_v min(candidate count, reference count)."""
+        out = np.zeros((self.n, n_refs))
+        used = np.unique(ref_cols)
+        if not len(used):
+            return out
+        pos = np.full(len(self.vocab), -1, np.int64)
+        step = max(1, _BLOCK_CELLS // max(self.n, n_refs, 1))
+        for start in range(0, len(used), step):
+            chunk = used[start:start + step]
+            pos[chunk] = np.arange(len(chunk))
+            c_sel = pos[self.cols] >= 0
+            r_sel = pos[ref_cols] >= 0
+            C = np.zeros((self.n, len(chunk)))
+            C[self.rows[c_sel], pos[self.cols[c_sel]]] = self.counts[c_sel]
+            R = np.zeros((n_refs, len(chunk)))
+            R[ref_rows[r_sel], pos[ref_cols[r_sel]]] = ref_counts[r_sel]
+            out += _min_sum(C, R)
+            pos[chunk] = -1
+        return out
+
+
+class _RefBlock:
+    """Per-family COO arrays for a block of references."""
+
+    def __init__(self, families):
+        self.rows = {f: [] for f in families}
+        self.cols = {f: [] for f in families}
+        self.counts = {f: [] for f in families}
+        self.totals = {f: [] for f in families}
+        self.lengths = []
+
+    def add(self, family: str, features: _Features, counter):
+        cols, counts, total = features.encode(counter)
+        self.rows[family].extend([len(self.totals[family])] * len(cols))
+        self.cols[family].extend(cols)
+        self.counts[family].extend(counts)
+        self.totals[family].append(total)
+
+    def min_sum(self, family: str, features: _Features, mask=None) -> np.ndarray:
+        rows = np.array(self.rows[family], np.int64)
+        cols = np.array(self.cols[family], np.int64)
+        counts = np.array(self.counts[family], np.float64)
+        if mask is not None and len(cols):
+            keep = mask[cols]
+            rows, cols, counts = rows[keep], cols[keep], counts[keep]
+        return features.min_sum(rows, cols, counts, len(self.lengths))
+
+
+def _ratio(num, den):
+    return np.divide(num, den, out=np.zeros(np.broadcast(num, den).shape), where=den > 0)
+
+
+class ScoreMatrix:
+    """Candidate features, built once, scored against the references a block at a time."""
+
+    def __init__(self, references, candidates, language: str="python", with_syntax_match: bool=None):
+        self.language = language
+        # Subtree counts need a parse of every text; skip them unless SyntaxMatch is wanted.
+        self.with_match = evaluator._wants_match(with_syntax_match)
+        self.components = COMPONENTS if self.with_match else tuple(c for c in COMPONENTS if c != "SyntaxMatch")
+        cands = [get_profile(c, language) for c in candidates]
+        keywords = LANG_KEYWORDS.get(language, set())
+        self.ngrams = [None] + [_Features([p.ngrams[n] for p in cands]) for n in range(1, MAX_ORDER + 1)]
+        # Columns (n-grams) containing a keyword; their matches are weighted in KeywordPrecision.
+        self.kw_masks = [None] + [np.array([any(tok in keywords for tok in ng) for ng in f.vocab], bool)
+                                  for f in self.ngrams[1:]]
+        self.kw_totals = [None] + [np.bincount(f.rows, f.counts * m[f.cols], minlength=len(cands)) if len(f.cols)
+                                   else np.zeros(len(cands)) for f, m in zip(self.ngrams[1:], self.kw_masks[1:])]
+        self.ops = _Features([p.ops for p in cands], {op: i for i, op in enumerate(SYNTAX_OPS)})
+        self.braces = _Features([p.braces for p in cands], {br: i for i, br in enumerate(SYNTAX_BRACES)})
+        self.identifiers = _Features([dict.fromkeys(p.identifiers, 1) for p in cands])
+        self.subtrees = _Features([p.subtrees if self.with_match else {} for p in cands])
+        self.cand_lengths = np.array([len(p) for p in cands], np.float64)
+        self.references = references
+
+    def blocks(self, block: int=MATRIX_REF_BLOCK):
+        """Yield (first reference index, {component: (N, b) array}) per block of references."""
+        refs = iter(self.references)
+        start = 0
+        while True:
+            current = _RefBlock(FAMILIES)
+            for text in refs:
+                ref = get_profile(text, self.language)
+                for n in range(1, MAX_ORDER + 1):
+                    current.add(f"ngram{n}", self.ngrams[n], ref.ngrams[n])
+                current.add("ops", self.ops, ref.ops)
+                current.add("braces", self.braces, ref.braces)
+                current.add("identifiers", self.identifiers, dict.fromkeys(ref.identifiers, 1))
+                current.add("subtrees", self.subtrees, ref.subtrees if self.with_match else {})
+                current.lengths.append(len(ref))
+                if len(current.lengths) >= block:
+                    break
+            if not current.lengths:
+                return
+            yield start, self._score(current)
+            start += len(current.lengths)
+
+    def _score(self, refs: _RefBlock) -> dict:
+        ref_lengths = np.array(refs.lengths, np.float64)[None, :]
+        cand_lengths = self.cand_lengths[:, None]
+        clip = kw_clip = total = kw_total = 0.0
+        geo = None
+        for n in range(1, MAX_ORDER + 1):
+            features, mask = self.ngrams[n], self.kw_masks[n]
+            kw_n = refs.min_sum(f"ngram{n}", features, mask)
+            clip_n = kw_n + refs.min_sum(f"ngram{n}", features, ~mask)
+            total_n = features.totals[:, None]
+            precision = _ratio(clip_n, total_n)
+            geo = precision if geo is None else geo * precision
+            clip, kw_clip = clip + clip_n, kw_clip + kw_n
+            total, kw_total = total + total_n, kw_total + self.kw_totals[n][:, None]
+        # Same operation order as _bleu_from_stats and _keyword_from_stats, so results are bit-identical.
+        bleu = np.where(geo > 0, np.power(geo, 0.25), 0.0)
+        brevity = np.where(cand_lengths > ref_lengths, 1.0, _ratio(cand_lengths, ref_lengths) + (ref_lengths == 0))
+        bleu = brevity * bleu
+        kw = _ratio((clip - kw_clip) + 1.1 * kw_clip, (total - kw_total) + 1.1 * kw_total)
+
+        syn = 0.0
+        for family, features in (("ops", self.ops), ("braces", self.braces)):
+            inter = refs.min_sum(family, features)
+            union = features.totals[:, None] + np.array(refs.totals[family], np.float64)[None, :] - inter
+            syn = syn + 0.5 * _ratio(inter, union)
+        shared = refs.min_sum("identifiers", self.identifiers)
+        union = self.identifiers.totals[:, None] + np.array(refs.totals["identifiers"], np.float64)[None, :] - shared
+        penalty = shared / np.maximum(union, 1)
+        scores = {"BLEU-4": bleu, "KeywordPrecision": kw, "SyntaxOverlap": syn, "IdentifierPenalty": penalty}
+        structure = syn
+        if self.with_match:
+            matched = refs.min_sum("subtrees", self.subtrees)
+            scores["SyntaxMatch"] = _ratio(matched, np.array(refs.totals["subtrees"], np.float64)[None, :])
+            if evaluator.SYNTAX_COMPONENT == "ast":
+                structure = scores["SyntaxMatch"]
+        scores["FinalScore"] = (0.4 * bleu + 0.4 * kw + 0.2 * structure) * penalty
+        return scores
+
+
+def _rounded(matrix: np.ndarray) -> list:
+    return [[round(v, 4) for v in row] for row in matrix.tolist()]
+
+
+def compute_codebleu_matrix(references, candidates, language: str="python", top_k: int=None,
+                            block: int=MATRIX_REF_BLOCK, with_syntax_match: bool=None) -> dict:
+    """Score every candidate against every reference.
+
+    Without top_k, "scores" maps each component to an N x M matrix (rows are
+    candidates). With top_k, "top_k" lists each candidate's best top_k
+    references by FinalScore, as {"reference": index, component: score}.
+    """
+    candidates = list(candidates)
+    matrix = ScoreMatrix(references, candidates, language, with_syntax_match)
+    components = matrix.components
+    n_refs = 0
+    if top_k is None:
+        parts = {name: [] for name in components}
+        for _, scores in matrix.blocks(block):
+            n_refs += scores["FinalScore"].shape[1]
+            for name in components:
+                parts[name].append(scores[name])
+        dense = {name: np.hstack(p) if p else np.zeros((len(candidates), 0)) for name, p in parts.items()}
+        return {"shape": [len(candidates), n_refs], "scores": {name: _rounded(m) for name, m in dense.items()}}
+
+    best_index = np.zeros((len(candidates), 0), np.int64)
+    best = {name: np.zeros((len(candidates), 0)) for name in components}
+    for start, scores in matrix.blocks(block):
+        width = scores["FinalScore"].shape[1]
+        n_refs += width
+        index = np.hstack([best_index, np.broadcast_to(np.arange(start, start + width), (len(candidates), width))])
+        merged = {name: np.hstack([best[name], scores[name]]) for name in components}
+        # Stable, so equal scores keep the lower reference index first.
+        order = np.argsort(-merged["FinalScore"], axis=1, kind="stable")[:, :top_k]
+        best_index = np.take_along_axis(index, order, axis=1)
+        best = {name: np.take_along_axis(m, order, axis=1) for name, m in merged.items()}
+    rows = []
+    for i in range(len(candidates)):
+        rows.append([{"reference": int(best_index[i, r]), **{name: round(float(best[name][i, r]), 4) for name in components}}
+                     for r in range(best_index.shape[1])])
+    return {"shape": [len(candidates), n_refs], "top_k": rows}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m score_matrix", description="All-pairs CodeBLEU scoring.")
+    parser.add_argument("input", help='JSON file of {"references": [...], "candidates": [...], "language": ...}, or -')
+    parser.add_argument("--top-k", type=int, help="keep only each candidate's best k references")
+    parser.add_argument("--language", help="overrides the input's language (default python)")
+    args = parser.parse_args(argv)
+    src = sys.stdin if args.input == "-" else open(args.input, encoding="utf-8")
+    with src:
+        data = json.load(src)
+    language = (args.language or str(data.get("language", "python"))).lower().strip()
+    result = compute_codebleu_matrix(data.get("references", []), data.get("candidates", []), language, args.top_k)
+    print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Coalesce identical in-flight requests and shed load once too many are queued.
+
+A burst of clients submitting the same prompt (or the same pair to score)
+should cost one upstream call, not one each. SingleFlight.do(key, fn) runs fn
+for the first caller with a given key; callers arriving while it runs wait for
+that result instead of starting their own. Once the call finishes the key is
+forgotten, so nothing is cached beyond the call itself.
+
+Each distinct in-flight key is one unit of queued work. When max_inflight
+keys are already running, a new key is refused with Overloaded, carrying a
+Retry-After estimate from recent call durations; duplicates of running keys
+are still admitted, since they add no work.
+"""
+import hashlib
+import json
+import math
+import os
+import threading
+import time
+
+from metrics import ADMISSION_REJECTS, COALESCED
+
+GENERATE_MAX_INFLIGHT = int(os.environ.get("GENERATE_MAX_INFLIGHT", "32"))
+EVALUATE_MAX_INFLIGHT = int(os.environ.get("EVALUATE_MAX_INFLIGHT", "64"))
+
+_EWMA_ALPHA = 0.2
+
+
+class Overloaded(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__(f"too many requests in flight; retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class _Call:
+    __slots__ = ("done", "result", "error", "waiters")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = self.error = None
+        self.waiters = 0
+
+
+def request_key(*parts) -> str:
+    """Stable key for a request's normalized fields."""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8", "surrogatepass")).hexdigest()
+
+
+class SingleFlight:
+    def __init__(self, name: str, max_inflight: int=0):
+        """max_inflight caps distinct concurrent keys; 0 means no limit."""
+        self.name, self.max_inflight = name, max_inflight
+        self.duration = None  # EWMA of call duration, seconds
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._calls)
+
+    def do(self, key: str, fn):
+        """(fn()'s result, shared) where shared is True if another caller's run was joined."""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                leader = False
+            elif self.max_inflight and len(self._calls) >= self.max_inflight:
+                ADMISSION_REJECTS.inc(route=self.name)
+                raise Overloaded(self.retry_after())
+            else:
+                call = self._calls[key] = _Call()
+                leader = True
+        if not leader:
+            COALESCED.inc(route=self.name)
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        start = time.perf_counter()
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                del self._calls[key]
+                self.duration = elapsed if self.duration is None else (
+                    _EWMA_ALPHA * elapsed + (1 - _EWMA_ALPHA) * self.duration)
+            call.done.set()
+        return call.result, False
+
+    def retry_after(self) -> int:
+        """Whole seconds until a slot is likely to free up (at least 1)."""
+        return max(1, math.ceil(self.duration or 0))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"inflight": len(self._calls), "waiting": sum(c.waiters for c in self._calls.values())}
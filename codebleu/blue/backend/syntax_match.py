@@ -0,0 +1,124 @@
+"""AST-based syntax match, as in the CodeBLEU paper.
+
+Each text is parsed into a tree of node labels (identifier names and
+literal values are dropped), and every subtree gets a structural hash
+computed bottom-up from its label and its children's hashes. Syntax match is
+the fraction of reference subtrees that also occur in the candidate, clipped
+by count, so comparing two trees is linear in their size.
+
+Python uses the standard `ast` module. Other languages go through the
+registered parser for that language; by default a bracket/statement parser
+over the shared tokenizer, which recovers blocks, argument lists and
+statements for the C-like languages. Register a real grammar (e.g. a
+tree-sitter binding) with register_parser.
+"""
+import ast
+import warnings
+from collections import Counter
+
+from evaluator import LANG_KEYWORDS, tokenize_code
+
+_OPENERS = {"(": ")", "[": "]", "{": "}"}
+_CLOSERS = {v: k for k, v in _OPENERS.items()}
+
+
+def parse_python(text: str, language: str="python"):
+    """Convert a Python AST into (label, children) tuples, skipping expression contexts."""
+    def convert(node):
+        children = tuple(convert(child) for child in ast.iter_child_nodes(node)
+                         if not isinstance(child, ast.expr_context))
+        return (type(node).__name__, children)
+    with warnings.catch_warnings():
+        # Candidates are arbitrary text; don't log "invalid escape sequence" and the like.
+        warnings.simplefilter("ignore", SyntaxWarning)
+        tree = ast.parse(text)
+    return convert(tree)
+
+
+def parse_brackets(text: str, language: str="python"):
+    """Language-agnostic tree: bracket pairs nest, ';' and closing '}' end statements."""
+    keywords = LANG_KEYWORDS.get(language, set())
+    root = ["unit", [], []]  # label, children, tokens of the open statement
+    stack = [root]
+
+    def flush(frame):
+        if frame[2]:
+            frame[1].append(("stmt", tuple(frame[2])))
+            frame[2] = []
+
+    for tok in tokenize_code(text):
+        frame = stack[-1]
+        if tok in _OPENERS:
+            stack.append([tok, [], []])
+        elif tok in _CLOSERS and len(stack) > 1 and stack[-1][0] == _CLOSERS[tok]:
+            stack.pop()
+            flush(frame)
+            stack[-1][2].append((frame[0], tuple(frame[1])))
+            if tok == "}":
+                flush(stack[-1])
+        elif tok == ";":
+            flush(frame)
+        elif tok in keywords:
+            frame[2].append((tok, ()))
+        elif tok[0].isdigit():
+            frame[2].append(("num", ()))
+        elif tok.isidentifier():
+            frame[2].append(("id", ()))
+        else:
+            frame[2].append((tok, ()))
+    while len(stack) > 1:
+        frame = stack.pop()
+        flush(frame)
+        stack[-1][2].append((frame[0], tuple(frame[1])))
+    flush(root)
+    return ("unit", tuple(root[1]))
+
+
+PARSERS = {"python": parse_python}
+
+
+def register_parser(language: str, parser):
+    """parser(text, language) -> (label, children) tree; raise SyntaxError/ValueError to fall back."""
+    PARSERS[language] = parser
+
+
+def parse(text: str, language: str="python"):
+    parser = PARSERS.get(language, parse_brackets)
+    try:
+        return parser(text, language)
+    except (SyntaxError, ValueError, RecursionError):
+        return parse_brackets(text, language)
+
+
+def subtree_hashes(tree) -> Counter:
+    """Count structural hashes of every internal (non-leaf) subtree, bottom-up and without recursion."""
+    counts = Counter()
+    values = []
+    stack = [(tree, False)]
+    while stack:
+        node, expanded = stack.pop()
+        label, children = node
+        if not expanded:
+            stack.append((node, True))
+            stack.extend((child, False) for child in reversed(children))
+            continue
+        if children:
+            h = hash((label, tuple(values[-len(children):])))
+            del values[-len(children):]
+            counts[h] += 1
+        else:
+            h = hash(label)
+        values.append(h)
+    return counts
+
+
+def subtree_counts(text: str, language: str="python") -> Counter:
+    return subtree_hashes(parse(text, language))
+
+
+def syntax_match(candidate_counts: Counter, reference_counts: Counter) -> float:
+    total = sum(reference_counts.values())
+    if total == 0:
+        return 0.0
+    matched = sum(min(c, candidate_counts.get(h, 0)) for h, c in reference_counts.items())
+    return matched / total
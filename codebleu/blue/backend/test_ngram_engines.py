@@ -0,0 +1,61 @@
+"""The NumPy n-gram engine must give exactly the Counter engine's counts and scores.
+
+    python test_ngram_engines.py   (or: python -m pytest test_ngram_engines.py)
+"""
+import random
+
+from evaluator import LANG_KEYWORDS, MAX_ORDER, _order_stats, compute_codebleu_detailed, get_profile, tokenize_code
+from array_ngrams import order_stats
+
+SNIPPETS = [
+    "def add(a, b):\n    return a + b",
+    "def add(x, y):\n    return x + y",
+    "for i in range(10):\n    if i % 2 == 0:\n        print(i)\n    else:\n        continue",
+    "int main() { int x = 0; for (int i = 0; i < 10; i++) { x += i; } return x; }",
+    "function f(a) { const b = a !== 3; return b ? a : -a; }",
+    "",
+    "x",
+]
+
+
+def random_code(rng: random.Random, length: int) -> str:
+    words = ["if", "else", "return", "for", "while", "def", "x", "y", "z", "=", "==", "(", ")", ":", "+", "1", "2"]
+    return " ".join(rng.choice(words) for _ in range(length))
+
+
+def assert_same(reference: str, candidate: str, language: str="python"):
+    keywords = LANG_KEYWORDS.get(language, set())
+    expected = _order_stats(get_profile(candidate, language), get_profile(reference, language), keywords, "counter")
+    actual = order_stats(tokenize_code(candidate), tokenize_code(reference), keywords, MAX_ORDER)
+    assert actual == expected, (reference, candidate, actual, expected)
+    assert (compute_codebleu_detailed(reference, candidate, language, engine="numpy")
+            == compute_codebleu_detailed(reference, candidate, language, engine="counter"))
+
+
+def test_snippets():
+    for reference in SNIPPETS:
+        for candidate in SNIPPETS:
+            for language in ("python", "cpp", "java", "javascript"):
+                assert_same(reference, candidate, language)
+
+
+def test_random():
+    rng = random.Random(0)
+    for _ in range(200):
+        assert_same(random_code(rng, rng.randint(0, 60)), random_code(rng, rng.randint(0, 60)))
+
+
+def test_long_token():
+    # One very long literal must not widen every token (a fixed-width string array would).
+    rng = random.Random(1)
+    literal = '"' + "a" * 20000 + '"'
+    reference = random_code(rng, 20000) + " s = " + literal
+    candidate = random_code(rng, 20000) + " s = " + literal
+    assert_same(reference, candidate)
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"{name}: ok")
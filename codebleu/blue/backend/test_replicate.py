@@ -0,0 +1,143 @@
+"""The Replicate client's polling, backoff, in-flight limit and cancellation, against fake_llm.
+
+    python test_replicate.py   (or: python -m pytest test_replicate.py)
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+from unittest import mock
+
+import requests
+
+import fake_llm
+import llm
+
+
+class RecordingSession(requests.Session):
+    """Session that notes each poll (GET) of a prediction."""
+
+    def __init__(self):
+        super().__init__()
+        self.polls = []
+
+    def get(self, url, **kwargs):
+        if "/stream" not in url:
+            self.polls.append(time.monotonic())
+        return super().get(url, **kwargs)
+
+
+class RecordingEvent(threading.Event):
+    """Cancel event that notes how long each wait between polls was."""
+
+    def __init__(self):
+        super().__init__()
+        self.waits = []
+
+    def wait(self, timeout=None):
+        self.waits.append(timeout)
+        return super().wait(timeout)
+
+
+@contextmanager
+def fake_replicate(slots: int=llm.REPLICATE_MAX_INFLIGHT, **settings):
+    """A fake_llm server wired into llm; settings override the llm.REPLICATE_* module settings."""
+    server = fake_llm.start_server(port=0, **settings.pop("server", {}))
+    session = RecordingSession()
+    overrides = {"REPLICATE_URL": f"http://127.0.0.1:{server.server_address[1]}/v1/predictions", "REPLICATE_WAIT": 0,
+                 "REPLICATE_POLL_INITIAL": 0.02, "REPLICATE_POLL_MAX": 0.08, "REPLICATE_TIMEOUT": 10.0,
+                 "_replicate_slots": threading.BoundedSemaphore(slots), "get_session": lambda: session, **settings}
+    try:
+        with mock.patch.dict(os.environ, {"REPLICATE_API_TOKEN": "fake"}), mock.patch.multiple(llm, **overrides):
+            yield server, session
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def statuses(server) -> list:
+    return sorted(p.status() for p in server.predictions.values())
+
+
+def test_polls_with_backoff_until_done():
+    with fake_replicate(server={"latency": 0.5, "stream": False}) as (server, session):
+        cancel = RecordingEvent()
+        assert llm._fetch_replicate("python", "add", cancel) == (200, fake_llm.DEFAULT_CODE)
+        assert len(session.polls) == len(cancel.waits) >= 4
+        # The delay doubles from REPLICATE_POLL_INITIAL up to REPLICATE_POLL_MAX.
+        assert cancel.waits[:4] == [0.02, 0.04, 0.08, 0.08], cancel.waits
+        assert statuses(server) == ["succeeded"]
+
+
+def test_prefer_wait_needs_no_polling():
+    with fake_replicate(REPLICATE_WAIT=5, server={"latency": 0.2}) as (server, session):
+        assert llm._fetch_replicate("python", "add") == (200, fake_llm.DEFAULT_CODE)
+        assert session.polls == []
+
+
+def test_timeout_cancels_prediction():
+    with fake_replicate(REPLICATE_TIMEOUT=0.2, server={"latency": 5, "stream": False}) as (server, _):
+        status, body = llm._fetch_replicate("python", "add")
+        assert status == 504, body
+        assert statuses(server) == ["canceled"]
+
+
+def test_cancel_event_stops_polling_and_streaming():
+    for stream in (False, True):
+        with fake_replicate(server={"latency": 5, "stream": stream}) as (server, _):
+            cancel = threading.Event()
+            threading.Timer(0.2, cancel.set).start()
+            start = time.monotonic()
+            assert llm._fetch_replicate("python", "add", cancel) == (499, "Generation cancelled")
+            assert time.monotonic() - start < 2
+            assert statuses(server) == ["canceled"]
+
+
+def test_stream_stops_after_code_block():
+    # The fenced block is complete well before the trailing prose has streamed.
+    with fake_replicate(server={"latency": 2, "chunk_size": 4}) as (server, _):
+        start = time.monotonic()
+        assert llm._fetch_replicate("python", "add") == (200, fake_llm.DEFAULT_CODE)
+        assert time.monotonic() - start < 2
+        assert statuses(server) == ["canceled"]
+
+
+def test_inflight_limit():
+    with fake_replicate(slots=2, server={"latency": 0.3, "stream": False}) as (server, _):
+        results, active, peak, lock = [], [0], [0], threading.Lock()
+        original = llm._await_prediction
+
+        def counting(*args, **kwargs):
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            try:
+                return original(*args, **kwargs)
+            finally:
+                with lock:
+                    active[0] -= 1
+
+        with mock.patch.object(llm, "_await_prediction", counting):
+            threads = [threading.Thread(target=lambda: results.append(llm._fetch_replicate("python", "add")))
+                       for _ in range(5)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        assert results == [(200, fake_llm.DEFAULT_CODE)] * 5
+        assert peak[0] == 2
+
+
+def test_inflight_limit_times_out():
+    with fake_replicate(slots=1, REPLICATE_TIMEOUT=0.1) as (server, _):
+        llm._replicate_slots.acquire()
+        status, body = llm._fetch_replicate("python", "add")
+        assert status == 503, body
+        assert server.predictions == {}
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"{name}: ok")
@@ -0,0 +1,81 @@
+"""Circuit breakers and failover in generate_code, with fake backends.
+
+    python test_router.py   (or: python -m pytest test_router.py)
+"""
+import os
+from unittest import mock
+
+import llm
+from router import CLOSED, HALF_OPEN, OPEN, BackendRouter
+
+
+def make_router() -> BackendRouter:
+    return BackendRouter(failures=1, cooldown=60)
+
+
+def half_open(router: BackendRouter, name: str):
+    router.record(name, 500, 0.1, "down")
+    router._get(name).opened_at -= router.cooldown
+    router.order([name])
+    assert router._get(name).state == HALF_OPEN
+
+
+def fake_backends(router: BackendRouter, outcomes: dict):
+    """call_ollama/call_replicate stand-ins that answer from outcomes[name] and report to router like _cached."""
+    calls = []
+
+    def backend(name):
+        def call(language, prompt, cancel=None, sampling=None):
+            calls.append(name)
+            status, body = outcomes[name].pop(0)
+            router.record(name, status, 0.01, None if status == 200 else body)
+            return status, body
+        return call
+
+    patches = mock.patch.multiple(llm, get_router=lambda: router, call_ollama=backend("ollama"),
+                                  call_replicate=backend("replicate"))
+    return patches, calls
+
+
+def test_breaker_opens_and_half_open_admits_one_trial():
+    router = make_router()
+    assert router.admit("ollama")
+    router.record("ollama", 500, 0.1, "boom")
+    assert router._get("ollama").state == OPEN
+    assert router.order(["ollama", "replicate"]) == ["replicate"]
+    half_open(router, "ollama")
+    assert router.admit("ollama")
+    assert not router.admit("ollama")
+    router.record("ollama", 200, 0.1)
+    assert router._get("ollama").state == CLOSED
+
+
+def test_unused_fallback_keeps_its_trial():
+    # A half-open Replicate must not lose its trial to requests Ollama answers on its own.
+    router = make_router()
+    half_open(router, "replicate")
+    patches, calls = fake_backends(router, {"ollama": [(200, "ok"), (500, "boom")], "replicate": [(200, "code")]})
+    with patches, mock.patch.dict(os.environ, {"USE_OLLAMA": "1", "LLM_HEDGE_DELAY": ""}):
+        assert llm.generate_code("python", "add") == (200, "ok")
+        assert llm.generate_code("python", "add") == (200, "code")
+    assert calls == ["ollama", "ollama", "replicate"]
+    assert router._get("replicate").state == CLOSED
+
+
+def test_hedge_admits_secondary_only_when_sent():
+    router = make_router()
+    half_open(router, "replicate")
+    patches, calls = fake_backends(router, {"ollama": [(200, "ok"), (500, "boom")], "replicate": [(200, "code")]})
+    with patches, mock.patch.dict(os.environ, {"USE_OLLAMA": "1", "LLM_HEDGE_DELAY": "5"}):
+        assert llm.generate_code("python", "add") == (200, "ok")
+        assert router._get("replicate").trial_started is None
+        # Ollama fails at once, so the hedge is sent straight away and gets the trial.
+        assert llm.generate_code("python", "add") == (200, "code")
+    assert calls == ["ollama", "ollama", "replicate"]
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"{name}: ok")
@@ -0,0 +1,78 @@
+"""All-pairs matrix scores must equal compute_codebleu_detailed for every pair.
+
+    python test_score_matrix.py   (or: python -m pytest test_score_matrix.py)
+"""
+from unittest import mock
+
+import evaluator
+from evaluator import compute_codebleu_detailed
+from score_matrix import MATRIX_LEVELS, compute_codebleu_matrix
+
+REFERENCES = [
+    "def add(a, b):\n    return a + b",
+    "for i in range(10):\n    if i % 2 == 0:\n        print(i)",
+    "",
+    "x",
+    # Counts above MATRIX_LEVELS on both sides take the per-column path.
+    " ".join(["x = x + 1 if x else ((x))"] * (MATRIX_LEVELS + 3)),
+]
+CANDIDATES = [
+    "def add(x, y):\n    return x + y",
+    "for j in range(3):\n    print(j)",
+    "",
+    " ".join(["x = x + 1 if x else ((x))"] * (MATRIX_LEVELS * 2)),
+    "if if if if if if if if if if if if ((((((((((((",
+]
+
+
+def expected(references, candidates):
+    return [[compute_codebleu_detailed(r, c, "python") for r in references] for c in candidates]
+
+
+def assert_dense(result, pairs):
+    assert result["shape"] == [len(pairs), len(pairs[0]) if pairs else 0]
+    for i, row in enumerate(pairs):
+        for j, detail in enumerate(row):
+            assert set(detail) - {"Recommendations"} == set(result["scores"]), (set(detail), set(result["scores"]))
+            for name, matrix in result["scores"].items():
+                assert matrix[i][j] == detail[name], (i, j, name, matrix[i][j], detail[name])
+
+
+def assert_top_k(result, pairs, k):
+    for i, row in enumerate(pairs):
+        best = result["top_k"][i]
+        assert len(best) == min(k, len(row))
+        assert [e["FinalScore"] for e in best] == sorted((d["FinalScore"] for d in row), reverse=True)[:k]
+        for entry in best:
+            detail = row[entry["reference"]]
+            assert {name: detail[name] for name in entry if name != "reference"} == \
+                {name: v for name, v in entry.items() if name != "reference"}
+
+
+def test_dense_and_top_k_both_syntax_modes():
+    for mode in ("overlap", "ast"):
+        with mock.patch.object(evaluator, "SYNTAX_COMPONENT", mode):
+            pairs = expected(REFERENCES, CANDIDATES)
+            assert ("SyntaxMatch" in pairs[0][0]) == (mode == "ast")
+            for block in (1, 2, 256):
+                assert_dense(compute_codebleu_matrix(REFERENCES, CANDIDATES, block=block), pairs)
+                for k in (1, 3, 10):
+                    assert_top_k(compute_codebleu_matrix(REFERENCES, CANDIDATES, top_k=k, block=block), pairs, k)
+
+
+def test_empty_lists():
+    for top_k in (None, 2):
+        result = compute_codebleu_matrix([], CANDIDATES, top_k=top_k)
+        assert result["shape"] == [len(CANDIDATES), 0]
+        result = compute_codebleu_matrix(REFERENCES, [], top_k=top_k)
+        assert result["shape"] == [0, len(REFERENCES)]
+        assert compute_codebleu_matrix([], [], top_k=top_k)["shape"] == [0, 0]
+    assert compute_codebleu_matrix(REFERENCES, [])["scores"]["FinalScore"] == []
+    assert compute_codebleu_matrix([], CANDIDATES, top_k=2)["top_k"] == [[]] * len(CANDIDATES)
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"{name}: ok")